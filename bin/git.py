@@ -693,7 +693,7 @@ commands = {
     }
 if __name__=='__main__':
     if len(sys.argv)==1:
-        sys.argv=sys.argv+['-h']
+        sys.argv.append('-h')
 
     ap = argparse.ArgumentParser()
     subparser=ap.add_subparsers()
@@ -0,0 +1,62 @@
+"""
+Remember or display the locations of command scripts.
+
+With no arguments, list the remembered commands and how many times each has
+been run. Commands are remembered when they are found in the current directory
+or BIN_PATH and are forgotten when BIN_PATH changes.
+"""
+from __future__ import print_function
+
+import sys
+import argparse
+
+
+def main(args):
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-r', '--reset', action='store_true',
+                    help='forget all remembered locations')
+    ap.add_argument('-d', '--delete', action='store_true',
+                    help='forget the remembered location of each name')
+    ap.add_argument('-t', '--type', action='store_true',
+                    help='print the location of each name')
+    ap.add_argument('names', nargs='*', help='command names')
+    ns = ap.parse_args(args)
+
+    _stash = globals()['_stash']
+    """:type : StaSh"""
+    rt = _stash.runtime
+
+    if ns.reset:
+        rt.reset_command_hash()
+
+    status = 0
+    for name in ns.names:
+        if ns.delete:
+            if rt.command_hash.pop(name, None) is None:
+                print('hash: {}: not found'.format(name), file=sys.stderr)
+                status = 1
+        else:
+            try:
+                # Looking up a command remembers it
+                filename = rt.find_script_file(name)
+            except Exception:
+                print('hash: {}: not found'.format(name), file=sys.stderr)
+                status = 1
+            else:
+                if ns.type:
+                    print(filename)
+
+    if not ns.names and not ns.reset:
+        if rt.command_hash:
+            print('hits\tcommand')
+            for name in sorted(rt.command_hash):
+                filename, hits = rt.command_hash[name]
+                print('{:>4d}\t{}'.format(hits, filename))
+        else:
+            print('hash: hash table empty')
+
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
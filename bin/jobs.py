@@ -3,17 +3,16 @@ List all jobs that are currently running.
 """
 import sys
 import argparse
-import threading
 
 def main(args):
     ap = argparse.ArgumentParser()
     ap.parse_args(args)
 
-    current_worker = threading.currentThread()
-
     _stash = globals()['_stash']
     """:type : StaSh"""
 
+    current_worker, _ = _stash.runtime.get_current_worker_and_state()
+
     for worker in _stash.get_workers():
         if worker.job_id != current_worker.job_id:
             print worker
@@ -21,7 +21,8 @@ ap.add_argument('name', help='file or module name')
 ap.add_argument('args_to_pass', nargs=argparse.REMAINDER, help='args to pass')
 args = ap.parse_args()
 
-sys.argv = [sys.argv[0]] + args.args_to_pass
+# Changed in place, as sys.argv dispatches to the running script's own
+sys.argv[1:] = args.args_to_pass
 
 if args.module:
     try:
@@ -55,6 +55,16 @@ py_pdb=0
 input_encoding_utf8=1
 ipython_style_history_search=1
 thread_type=ctypes
+worker_pool_size=4
+parser_cache_size=64
+parser_engine=pyparsing
+pipe_buffer_size=65536
+output_buffer_mode=interactive
+py_code_cache_size=32
+py_code_cache_dir=
+process_commands=
+process_pool_size=2
+scrollback_max=10000
 
 [display]
 TEXT_FONT_SIZE={text_size}
@@ -91,6 +101,7 @@ class StaSh(object):
         # Wire the components
         self.main_screen = ShSequentialScreen(self,
                                               nlines_max=self.config.getint('display', 'BUFFER_MAX'),
+                                              scrollback_max=self.config.getint('system', 'scrollback_max'),
                                               debug=_DEBUG_MAIN_SCREEN in debug)
 
         self.mini_buffer = ShMiniBuffer(self,
@@ -108,7 +119,9 @@ class StaSh(object):
         self.renderer = ShSequentialRenderer(self.main_screen, self.terminal,
                                              debug=_DEBUG_RENDERER in debug)
 
-        parser = ShParser(debug=_DEBUG_PARSER in debug)
+        parser = ShParser(debug=_DEBUG_PARSER in debug,
+                          cache_size=self.config.getint('system', 'parser_cache_size'),
+                          engine=self.config.get('system', 'parser_engine'))
         expander = ShExpander(self, debug=_DEBUG_EXPANDER in debug)
         self.runtime = ShRuntime(self, parser, expander, debug=_DEBUG_RUNTIME in debug)
         self.completer = ShCompleter(self, debug=_DEBUG_COMPLETER in debug)
@@ -1,8 +1,13 @@
 # coding: utf-8
+import errno
 import logging
+import thread
+import threading
 import time
 from collections import deque
 
+from .shthreads import _WORKER_LOCAL
+
 
 class ShIO(object):
     """
@@ -17,18 +22,140 @@ class ShIO(object):
         self.debug = debug
         self.logger = logging.getLogger('StaSh.IO')
         self.tell_pos = 0
-        # The input buffer, push from the Left end, read from the right end
+        # The input buffer holds the pushed strings as whole chunks. Push to the
+        # right end and read from the left end, where the first offset characters
+        # of the leftmost chunk have already been read.
         self._buffer = deque()
+        self._offset = 0
+        self._size = 0
         self.chunk_size = 4096
-        # When buffer is empty, hold back for certain before read again
-        # This is to lower the cpu usage of the reading thread so it does
-        # not affect the UI thread by noticeable amount
-        self.holdback = 0.2
+        # Readers block on their own waiter lock until input is pushed. The lock
+        # protects both the buffer and the waiters.
+        self._lock = threading.Lock()
+        self._waiters = []
+        # A killed reader does not block, instead it holds back briefly so the
+        # kill can take effect
+        self.holdback = 0.05
 
         self.encoding = 'utf8'
 
     def push(self, s):
-        self._buffer.extendleft(s)
+        if len(s) == 0:
+            return
+        with self._lock:
+            self._buffer.append(s)
+            self._size += len(s)
+            self._release_waiters()
+
+    def buffered(self):
+        """
+        Peek at the input that is pushed but not read yet.
+        :rtype: str
+        """
+        with self._lock:
+            return ''.join(self._buffer)[self._offset:]
+
+    def _find(self, c):
+        """
+        Find a character in the buffer. Must be called with the lock acquired.
+        :param str c: The character to find.
+        :return: Number of characters up to and including the first c, -1 if not found
+        :rtype: int
+        """
+        n = 0
+        offset = self._offset
+        for chunk in self._buffer:
+            idx = chunk.find(c, offset)
+            if idx != -1:
+                return n + idx - offset + 1
+            n += len(chunk) - offset
+            offset = 0
+        return -1
+
+    def _take(self, n):
+        """
+        Remove up to n characters from the buffer. Must be called with the lock
+        acquired.
+        :param int n: Number of characters, -1 to take everything.
+        :rtype: str
+        """
+        if n < 0 or n > self._size:
+            n = self._size
+        ret = []
+        remaining = n
+        while remaining > 0:
+            chunk = self._buffer[0]
+            end = self._offset + remaining
+            if end < len(chunk):
+                ret.append(chunk[self._offset:end])
+                self._offset = end
+                break
+            ret.append(chunk[self._offset:] if self._offset else chunk)
+            remaining -= len(chunk) - self._offset
+            self._buffer.popleft()
+            self._offset = 0
+        self._size -= n
+        return ''.join(ret)
+
+    def flush_output(self):
+        """
+        Flush the output buffered by the worker running in the current thread, so
+        that it goes to the screen before anything the worker writes or reads next.
+        """
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        if state is not None:
+            if isinstance(state.sys_stdout, ShBufferedOutput):
+                state.sys_stdout.flush()
+            if state.sys_stderr is not state.sys_stdout and isinstance(state.sys_stderr, ShBufferedOutput):
+                state.sys_stderr.flush()
+
+    def wake_up(self):
+        """
+        Wake up all blocked readers, e.g. when one of them is killed.
+        """
+        with self._lock:
+            self._release_waiters()
+
+    def _release_waiters(self):
+        """
+        Must be called with the lock acquired.
+        """
+        for waiter in self._waiters:
+            waiter.release()
+        self._waiters = []
+
+    def _add_waiter(self):
+        """
+        Prepare the current thread to wait for more input. Must be called with the
+        lock acquired, and the returned waiter is then passed to _wait after the
+        lock is released.
+        :return: The waiter lock, None if the current worker has been killed
+        """
+        worker = getattr(_WORKER_LOCAL, 'worker', None)
+        if worker is not None:
+            # The worker must be reachable for wake up before its killed flag is checked
+            worker.blocked_on = self
+            if worker.killed:
+                return None
+        waiter = thread.allocate_lock()
+        waiter.acquire()
+        self._waiters.append(waiter)
+        return waiter
+
+    def _wait(self, waiter):
+        """
+        Block till the waiter is released by push or wake_up. Must be called
+        without the lock acquired.
+        """
+        try:
+            if waiter is None:
+                time.sleep(self.holdback)
+            else:
+                waiter.acquire()
+        finally:
+            worker = getattr(_WORKER_LOCAL, 'worker', None)
+            if worker is not None:
+                worker.blocked_on = None
 
     # Following methods to provide file like object interface
     @property
@@ -60,33 +187,46 @@ class ShIO(object):
         """do nothing"""
 
     def read(self, size=-1):
+        self.flush_output()
         size = size if size != 0 else 1
 
-        if size == -1:
-            return ''.join(self._buffer.pop() for _ in len(self._buffer))
-
-        else:
-            ret = []
-            while len(ret) < size:
-                try:
-                    ret.append(self._buffer.pop())
-                except IndexError:
-                    # Wait briefly when the buffer is empty to avoid taxing the CPU
-                    time.sleep(self.holdback)
-
-            return ''.join(ret)
+        ret = []
+        n = 0
+        while True:
+            with self._lock:
+                if size == -1:
+                    idx = self._find('\0')
+                    if idx != -1:
+                        ret.append(self._take(idx)[:-1])  # do not include the EOF
+                        return ''.join(ret)
+                    ret.append(self._take(-1))
+                else:
+                    ret.append(self._take(size - n))
+                    n += len(ret[-1])
+                    if n >= size:
+                        return ''.join(ret)
+                waiter = self._add_waiter()
+            self._wait(waiter)
 
-    def readline(self, size=-1):
+    def _read_until(self, c):
+        """
+        Read till the given character is read, including the character.
+        """
         ret = []
         while True:
-            try:
-                ret.append(self._buffer.pop())
-                if ret[-1] == '\n':
-                    break
-            except IndexError:
-                time.sleep(self.holdback)
+            with self._lock:
+                idx = self._find(c)
+                if idx != -1:
+                    ret.append(self._take(idx))
+                    return ''.join(ret)
+                # Keep the incomplete part so the buffer is not scanned again
+                ret.append(self._take(-1))
+                waiter = self._add_waiter()
+            self._wait(waiter)
 
-        line = ''.join(ret)
+    def readline(self, size=-1):
+        self.flush_output()
+        line = self._read_until('\n')
         # localized history for running scripts
         # TODO: Adding to history for read as well?
         self.stash.runtime.add_history(line)
@@ -94,16 +234,8 @@ class ShIO(object):
         return line
 
     def readlines(self, size=-1):
-        ret = []
-        while True:
-            try:
-                ret.append(self._buffer.pop())
-                if ret[-1] == '\0':
-                    break
-            except IndexError:
-                time.sleep(self.holdback)
-
-        ret = ''.join(ret[:-1])  # do not include the EOF
+        self.flush_output()
+        ret = self._read_until('\0')[:-1]  # do not include the EOF
 
         if size != -1:
             ret = ret[:size]
@@ -122,13 +254,18 @@ class ShIO(object):
         The caller is responsible for break out this reading explicitly.
         """
         # TODO: Currently not supported by ShMiniBuffer
+        self.flush_output()
         try:
             self.stash.mini_buffer.cbreak = True
             while True:
-                try:
-                    yield self._buffer.pop()
-                except IndexError:
-                    time.sleep(self.holdback)
+                with self._lock:
+                    c = self._take(1)
+                    if not c:
+                        waiter = self._add_waiter()
+                if not c:
+                    self._wait(waiter)
+                else:
+                    yield c
 
         finally:
             self.stash.mini_buffer.cbreak = False
@@ -142,20 +279,21 @@ class ShIO(object):
         user command when a program is running at the same time.
         :return: str:
         """
-        ret = []
         while True:
-            try:
-                ret.append(self._buffer.pop())
-                if ret[-1] == '\n':
-                    yield ''.join(ret)
-                    ret = []
-            except IndexError:
-                self._buffer.extend(ret)
-                break
+            with self._lock:
+                idx = self._find('\n')
+                if idx == -1:
+                    break
+                line = self._take(idx)
+            yield line
 
     def write(self, s, no_wait=False):
         if len(s) == 0:  # skip empty string
             return
+        self.flush_output()
+        self._write(s, no_wait=no_wait)
+
+    def _write(self, s, no_wait=False):
         idx = 0
         while True:
             self.stash.stream.feed(s[idx: idx + self.chunk_size], no_wait=no_wait)  # main screen only
@@ -168,3 +306,335 @@ class ShIO(object):
 
     def flush(self):
         pass
+
+
+class ShOutputFlusher(object):
+    """
+    Flush output buffers once their time is up. A single long-lived thread
+    serves all buffers, so no thread is started per batch. It waits without a
+    timeout while no buffer is scheduled.
+    """
+
+    def __init__(self):
+        self._scheduled = {}  # output buffer to the time it must be flushed at
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self.flush_thread = None
+
+    def schedule(self, output_buffer):
+        """
+        Flush the buffer once its time budget has passed.
+        :param ShBufferedOutput output_buffer: The buffer
+        """
+        with self._lock:
+            self._scheduled.setdefault(output_buffer, time.time() + output_buffer.time_max)
+            if self.flush_thread is None:
+                self.flush_thread = threading.Thread(name='_shflusher', target=self._run)
+                self.flush_thread.daemon = True
+                self.flush_thread.start()
+        self._wakeup.set()
+
+    def cancel(self, output_buffer):
+        with self._lock:
+            self._scheduled.pop(output_buffer, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                due = [b for b, flush_time in self._scheduled.items() if flush_time <= now]
+                for output_buffer in due:
+                    del self._scheduled[output_buffer]
+                timeout = min(self._scheduled.values()) - now if self._scheduled else None
+                # Cleared with the lock held so that a buffer scheduled from now on wakes it up
+                self._wakeup.clear()
+            for output_buffer in due:
+                try:
+                    output_buffer._flush_on_time()
+                except Exception as e:
+                    logging.getLogger('StaSh.IO').error('timed flush failed: %s' % repr(e))
+            due = output_buffer = None  # the buffers are not held while waiting
+            self._wakeup.wait(timeout)
+
+
+class ShBufferedOutput(object):
+    """
+    Output buffer of a worker that writes to the screen. Small writes, e.g. one
+    per print statement, are batched so that the screen is locked and fed once
+    per batch instead of once per write. The buffer is flushed once it holds the
+    given number of lines, once its oldest write has waited for the given time,
+    on an explicit flush, before the worker reads input and at script end.
+
+    :param ShIO io: The IO object to write the batches to.
+    :param int lines_max: Number of buffered lines that triggers a flush.
+    :param float time_max: Maximum seconds a write is held back.
+    """
+
+    #: Flush thresholds, as (lines_max, time_max), of the output buffer modes
+    MODES = {
+        'interactive': (1000, 0.05),
+        'throughput': (10000, 0.5),
+    }
+
+    #: Flushes the buffers whose oldest write has waited for their time budget
+    flusher = ShOutputFlusher()
+
+    def __init__(self, io, lines_max=1000, time_max=0.05):
+        self.io = io
+        self.lines_max = lines_max
+        self.time_max = time_max
+        self._chunks = []
+        self._nlines = 0
+        self._scheduled = False
+        # The buffer is written to by the worker and flushed by the flusher as well
+        self._lock = threading.Lock()
+
+        self.n_flushes = 0
+
+    @classmethod
+    def from_mode(cls, io, mode):
+        """
+        :param ShIO io: The IO object to write the batches to.
+        :param str mode: interactive or throughput
+        :rtype: ShBufferedOutput
+        """
+        lines_max, time_max = cls.MODES[mode]
+        return cls(io, lines_max=lines_max, time_max=time_max)
+
+    def __getattr__(self, item):
+        return getattr(self.io, item)
+
+    def write(self, s):
+        with self._lock:
+            self._chunks.append(s)
+            if not self._scheduled:
+                self._scheduled = True
+                self.flusher.schedule(self)
+            if '\n' in s:
+                self._nlines += s.count('\n')
+                if self._nlines >= self.lines_max:
+                    self._flush()
+
+    def writelines(self, s_list):
+        self.write(''.join(s_list))
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        """
+        Must be called with the lock acquired.
+        """
+        if self._chunks:
+            s = ''.join(self._chunks)
+            self._chunks = []
+            self._nlines = 0
+            self.n_flushes += 1
+            self.io._write(s)
+
+    def _flush_on_time(self):
+        with self._lock:
+            self._scheduled = False
+            self._flush()
+
+    def close(self):
+        """
+        Flush what is left and cancel the timed flush. The buffer can still be
+        written to.
+        """
+        with self._lock:
+            if self._scheduled:
+                self.flusher.cancel(self)
+                self._scheduled = False
+            self._flush()
+
+
+class ShPipe(object):
+    """
+    A bounded in-memory pipe that connects two commands of a pipe sequence running
+    in different worker threads. Writes block while the buffer is full and reads
+    block while it is empty. After the write end is closed, readers get what is
+    left in the buffer followed by EOF. After the read end is closed, writes fail
+    with a broken pipe error so that the upstream command stops early.
+
+    :param int maxsize: Maximum number of characters held in the buffer.
+    """
+
+    # A killed worker does not block, instead it holds back briefly so the kill can
+    # take effect
+    holdback = 0.05
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._chunks = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self.write_closed = False
+        self.read_closed = False
+
+        self.encoding = 'utf8'
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+    @property
+    def closed(self):
+        return self.write_closed and self.read_closed
+
+    def isatty(self):
+        return False
+
+    def close_write(self):
+        """
+        Signal EOF to the reader.
+        """
+        with self._cond:
+            self.write_closed = True
+            self._cond.notify_all()
+
+    def close_read(self):
+        """
+        The reader is done. Any buffered and further writes are discarded.
+        """
+        with self._cond:
+            self.read_closed = True
+            self._chunks.clear()
+            self._size = 0
+            self._cond.notify_all()
+
+    def close(self):
+        self.close_write()
+        self.close_read()
+
+    def wake_up(self):
+        """
+        Wake up the blocked reader or writer, e.g. when it is killed.
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+    def _wait(self):
+        """
+        Block till the pipe is read from, written to, closed or woken up. Must
+        be called with the condition acquired.
+        """
+        worker = getattr(_WORKER_LOCAL, 'worker', None)
+        if worker is None:
+            self._cond.wait()
+            return
+        # The worker must be reachable for wake up before its killed flag is checked
+        worker.blocked_on = self
+        try:
+            if worker.killed:
+                self._cond.wait(self.holdback)
+            else:
+                self._cond.wait()
+        finally:
+            worker.blocked_on = None
+
+    def write(self, s):
+        if len(s) == 0:  # skip empty string
+            return
+        with self._cond:
+            while True:
+                if self.read_closed:
+                    raise IOError(errno.EPIPE, 'Broken pipe')
+                if self.write_closed:
+                    raise ValueError('I/O operation on closed file')
+                if self._size < self.maxsize:
+                    break
+                self._wait()
+            # A write is never split so the buffer may go over maxsize by one write
+            self._chunks.append(s)
+            self._size += len(s)
+            self._cond.notify_all()
+
+    def writelines(self, s_list):
+        self.write(''.join(s_list))
+
+    def flush(self):
+        pass
+
+    def _wait_for_data(self):
+        """
+        Wait till there is buffered data or the write end is closed.
+        Must be called with the condition acquired.
+        :return: False if EOF is reached
+        :rtype: bool
+        """
+        while not self._chunks:
+            if self.write_closed or self.read_closed:
+                return False
+            self._wait()
+        return True
+
+    def _take(self, n):
+        """
+        Remove the first n characters from the buffer. Must be called with the
+        condition acquired.
+        """
+        ret = []
+        while n > 0 and self._chunks:
+            chunk = self._chunks.popleft()
+            if len(chunk) > n:
+                self._chunks.appendleft(chunk[n:])
+                chunk = chunk[:n]
+            ret.append(chunk)
+            n -= len(chunk)
+        s = ''.join(ret)
+        self._size -= len(s)
+        self._cond.notify_all()
+        return s
+
+    def read(self, size=-1):
+        """
+        Read up to size characters. Unlike a regular file, a read with a given
+        size returns as soon as any data is available.
+        """
+        with self._cond:
+            if size is None or size < 0:
+                ret = []
+                while self._wait_for_data():
+                    ret.append(self._take(self._size))
+                return ''.join(ret)
+            elif not self._wait_for_data():
+                return ''
+            else:
+                return self._take(size)
+
+    def readline(self, size=-1):
+        with self._cond:
+            ret = []
+            n = 0
+            while size is None or size < 0 or n < size:
+                if not self._wait_for_data():
+                    break
+                chunk = self._chunks[0]
+                idx = chunk.find('\n') + 1 or len(chunk)
+                if size is not None and 0 <= size < n + idx:
+                    idx = size - n
+                ret.append(self._take(idx))
+                n += idx
+                if ret[-1].endswith('\n'):
+                    break
+            return ''.join(ret)
+
+    def readlines(self, sizehint=-1):
+        ret = []
+        total = 0
+        while True:
+            line = self.readline()
+            if line == '':
+                break
+            ret.append(line)
+            total += len(line)
+            if 0 < sizehint <= total:
+                break
+        return ret
@@ -1,9 +1,12 @@
 # coding: utf-8
 """
-The wrappers dispatch io requests based on current thread.
+The wrappers dispatch io requests, as well as os.environ and sys.path, based on
+current thread. The os.environ and sys.path wrappers are only installed while
+python scripts are running.
 
-If the thread is an instance of ShBaseThread, the io should be dispatched to ShIO.
-Otherwise, it should be dispatched to regular sys io.
+If the thread runs a worker (ShBaseThread), the io should be dispatched to ShIO.
+Otherwise, it should be dispatched to regular sys io. The pool thread that runs
+a worker puts the worker's state in a thread local slot when it starts.
 
 These classes are necessary because print seems to remember the real sys module
 and its io properties, e.g. stdout. Even when a mock sys is provided with
@@ -11,56 +14,406 @@ shimportproxy, print always ignore the io properties of the mock sys object and
 uses settings from the real object. Maybe it is because print is a C builtin
 function and somehow manage the import differently?
 """
+import os
 import sys
+import imp
+import copy
+import pkgutil
+import fileinput
 import threading
+from collections import MutableMapping
 
-from .shcommon import _SYS_STDIN, _SYS_STDOUT, _SYS_STDERR
-from .shthreads import ShBaseThread
+from .shcommon import _SYS_STDIN, _SYS_STDOUT, _SYS_STDERR, _SYS_PATH, _OS_ENVIRON
+from .shthreads import _WORKER_LOCAL
 
+_SYS_ARGV = sys.argv
 
-class ShStdinWrapper(object):
 
-    def __getattribute__(self, item):
-        thread = threading.currentThread()
+class ShStreamWrapper(object):
+    """
+    Forward attribute access to the stream of the current worker, or to the
+    regular sys stream outside of workers. The class is also forwarded so that
+    isinstance checks on the wrapper see the actual stream. Subclasses define
+    the frequently used methods directly, which is much faster than going
+    through __getattr__. The softspace flag of print is kept by the wrapper.
+    """
+    _default_stream = None
+    _state_attr = None
 
-        if isinstance(thread, ShBaseThread):
-            return getattr(thread.state.sys_stdin, item)
-        else:
-            return getattr(_SYS_STDIN, item)
+    def _stream(self):
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        return self._default_stream if state is None else getattr(state, self._state_attr)
 
-class ShStdoutWrapper(object):
+    @property
+    def __class__(self):
+        return self._stream().__class__
 
-    def __getattribute__(self, item):
-        thread = threading.currentThread()
+    def __getattr__(self, item):
+        return getattr(self._stream(), item)
 
-        if isinstance(thread, ShBaseThread):
-            return getattr(thread.state.sys_stdout, item)
-        else:
-            return getattr(_SYS_STDOUT, item)
 
+class ShStdinWrapper(ShStreamWrapper):
+    _default_stream = _SYS_STDIN
+    _state_attr = 'sys_stdin'
 
-class ShStderrWrapper(object):
+    def read(self, *args):
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        return (_SYS_STDIN if state is None else state.sys_stdin).read(*args)
 
-    def __getattribute__(self, item):
-        thread = threading.currentThread()
+    def readline(self, *args):
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        return (_SYS_STDIN if state is None else state.sys_stdin).readline(*args)
 
-        if isinstance(thread, ShBaseThread):
-            return getattr(thread.state.sys_stderr, item)
-        else:
-            return getattr(_SYS_STDERR, item)
+
+class ShStdoutWrapper(ShStreamWrapper):
+    _default_stream = _SYS_STDOUT
+    _state_attr = 'sys_stdout'
+
+    def write(self, s):
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        (_SYS_STDOUT if state is None else state.sys_stdout).write(s)
+
+    def flush(self):
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        (_SYS_STDOUT if state is None else state.sys_stdout).flush()
+
+
+class ShStderrWrapper(ShStreamWrapper):
+    _default_stream = _SYS_STDERR
+    _state_attr = 'sys_stderr'
+
+    def write(self, s):
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        (_SYS_STDERR if state is None else state.sys_stderr).write(s)
+
+    def flush(self):
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        (_SYS_STDERR if state is None else state.sys_stderr).flush()
+
+
+class ShArgvWrapper(object):
+    """
+    Scripts running at the same time, e.g. commands in a pipe sequence, each
+    have their own sys.argv. Special methods are not looked up through
+    __getattr__, hence they are forwarded explicitly. Scripts must change
+    sys.argv in place, e.g. sys.argv[1:] = args, as assigning to it replaces
+    the wrapper.
+    """
+
+    @staticmethod
+    def _argv():
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        return _SYS_ARGV if state is None else state.sys_argv
+
+    def __getattr__(self, item):
+        return getattr(self._argv(), item)
+
+    def __getitem__(self, idx):
+        return self._argv()[idx]
+
+    def __getslice__(self, i, j):
+        return self._argv()[i:j]
+
+    def __setitem__(self, idx, value):
+        self._argv()[idx] = value
+
+    def __delitem__(self, idx):
+        del self._argv()[idx]
+
+    def __setslice__(self, i, j, value):
+        self._argv()[i:j] = value
+
+    def __delslice__(self, i, j):
+        del self._argv()[i:j]
+
+    def __iadd__(self, other):
+        self._argv().extend(other)
+        return self
+
+    def __len__(self):
+        return len(self._argv())
+
+    def __iter__(self):
+        return iter(self._argv())
+
+    def __contains__(self, item):
+        return item in self._argv()
+
+    def __eq__(self, other):
+        return self._argv() == other
+
+    def __ne__(self, other):
+        return self._argv() != other
+
+    def __add__(self, other):
+        return self._argv() + other
+
+    def __radd__(self, other):
+        return other + self._argv()
+
+    def __repr__(self):
+        return repr(self._argv())
+
+
+class ShEnvironWrapper(MutableMapping):
+    """
+    A running script has its own os.environ, so that scripts running at the same
+    time do not see each other's variables. It is a regular dict, as it was when
+    scripts got a copy of os.environ, and the class is forwarded so that isinstance
+    checks see it. Outside of scripts, this is the regular os.environ.
+    """
+
+    @staticmethod
+    def _environ():
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        if state is None or state.script_environ is None:
+            return _OS_ENVIRON
+        return state.script_environ
+
+    @property
+    def __class__(self):
+        return self._environ().__class__
+
+    @property
+    def data(self):
+        """
+        The dict of the variables, same as the data of the regular os.environ.
+        """
+        environ = self._environ()
+        return environ.data if environ is _OS_ENVIRON else environ
+
+    def __getattr__(self, item):
+        return getattr(self._environ(), item)
+
+    def __getitem__(self, key):
+        return self._environ()[key]
+
+    def __setitem__(self, key, value):
+        self._environ()[key] = value
+
+    def __delitem__(self, key):
+        del self._environ()[key]
+
+    def __iter__(self):
+        return iter(self._environ().keys())
+
+    def __len__(self):
+        return len(self._environ())
+
+    def __contains__(self, key):
+        return key in self._environ()
+
+    def __copy__(self):
+        return copy.copy(self._environ())
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._environ(), memo)
+
+    def has_key(self, key):
+        return key in self._environ()
+
+    def get(self, key, default=None):
+        return self._environ().get(key, default)
+
+    def keys(self):
+        return self._environ().keys()
+
+    def copy(self):
+        return self._environ().copy()
+
+    def __repr__(self):
+        return repr(self._environ())
+
+
+def _path_method(name):
+    """
+    A list method of ShSysPathWrapper that works on the sys.path of the running
+    script, or on the wrapper itself outside of scripts.
+    """
+    method = getattr(list, name)
+
+    def fn(self, *args):
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        if state is None or state.script_sys_path is None:
+            return method(self, *args)
+        return method(state.script_sys_path, *args)
+    fn.__name__ = name
+    return fn
+
+
+class ShSysPathWrapper(list):
+    """
+    A running script has its own sys.path, so that scripts running at the same
+    time do not see each other's paths. The wrapper must be a list because the
+    import machinery only accepts a list, of which it reads the items directly.
+    Hence the wrapper holds the regular sys.path as its own items and imports
+    from the sys.path of a script are done by ShPathFinder.
+    """
+    for _name in ('__getitem__', '__setitem__', '__delitem__', '__getslice__', '__setslice__',
+                  '__delslice__', '__len__', '__iter__', '__reversed__', '__contains__',
+                  '__eq__', '__ne__', '__add__', '__mul__', '__repr__',
+                  'append', 'extend', 'insert', 'pop', 'remove', 'index', 'count',
+                  'reverse', 'sort'):
+        locals()[_name] = _path_method(_name)
+    del _name
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def base(self):
+        """
+        :return: The regular sys.path
+        :rtype: list
+        """
+        return list.__getslice__(self, 0, sys.maxint)
+
+
+class ShPathFinder(object):
+    """
+    Meta path finder that imports top level modules from the sys.path of the
+    running script, if it is not the same as the regular sys.path. The paths are
+    searched in order with their importers, e.g. for zip files, the same way as
+    the regular import does. Submodules are imported from the __path__ of their
+    packages by the regular import, which is the same for all sys.path.
+    """
+
+    def find_module(self, fullname, path=None):
+        if path is not None:  # a submodule of a package
+            return None
+        state = getattr(_WORKER_LOCAL, 'state', None)
+        if state is None or state.script_sys_path is None:
+            return None
+        script_sys_path = state.script_sys_path
+        if sys.path is not pathWrapper or list.__eq__(pathWrapper, script_sys_path):
+            return None
+        # These are found before sys.path by the regular import
+        if imp.is_builtin(fullname) or imp.is_frozen(fullname):
+            return None
+        for path_item in list(script_sys_path):
+            if not isinstance(path_item, basestring):
+                continue
+            importer = pkgutil.get_importer(path_item)
+            if importer is not None:
+                loader = importer.find_module(fullname)
+                if loader is not None:
+                    return loader
+        return None
 
 
 stdinWrapper = ShStdinWrapper()
 stdoutWrapper = ShStdoutWrapper()
 stderrWrapper = ShStderrWrapper()
+argvWrapper = ShArgvWrapper()
+environWrapper = ShEnvironWrapper()
+pathWrapper = ShSysPathWrapper()
+pathFinder = ShPathFinder()
+
+
+# The fileinput module keeps its state in a module global which would be shared
+# by all running scripts. Its module functions are replaced by ones that keep the
+# state per thread.
+_FILEINPUT_FUNCTIONS = ('input', 'close', 'nextfile', 'filename', 'lineno',
+                        'filelineno', 'fileno', 'isfirstline', 'isstdin')
+_fileinput_originals = dict((name, getattr(fileinput, name)) for name in _FILEINPUT_FUNCTIONS)
+_fileinput_local = threading.local()
+
+
+def _fileinput_input(files=None, inplace=0, backup="", bufsize=0, mode="r", openhook=None):
+    state = getattr(_fileinput_local, 'state', None)
+    if state and state._file:
+        raise RuntimeError("input() already active")
+    _fileinput_local.state = fileinput.FileInput(files, inplace, backup, bufsize, mode, openhook)
+    return _fileinput_local.state
+
+
+def _fileinput_close():
+    state = getattr(_fileinput_local, 'state', None)
+    _fileinput_local.state = None
+    if state:
+        state.close()
+
+
+def _fileinput_state_function(name):
+    def fn():
+        state = getattr(_fileinput_local, 'state', None)
+        if not state:
+            raise RuntimeError("no active input()")
+        return getattr(state, name)()
+    fn.__name__ = name
+    return fn
+
+
+_fileinput_replacements = dict((name, _fileinput_state_function(name)) for name in _FILEINPUT_FUNCTIONS)
+_fileinput_replacements.update(input=_fileinput_input, close=_fileinput_close)
+
+
+#: Number of scripts running at the same time, os.environ and sys.path are
+#: dispatched to the running scripts as long as there is any
+_n_scripts = 0
+_scripts_lock = threading.Lock()
+
+
+def begin_script():
+    """
+    Dispatch os.environ and sys.path to the running scripts, before a script
+    gets its own ones. Must be paired with end_script.
+    """
+    global _n_scripts
+    with _scripts_lock:
+        if _n_scripts == 0:
+            list.__init__(pathWrapper, _SYS_PATH)
+            sys.path = pathWrapper
+            os.environ = environWrapper
+        _n_scripts += 1
+
+
+def end_script():
+    """
+    Use the regular os.environ and sys.path again after the last running script
+    has ended.
+    """
+    global _n_scripts
+    with _scripts_lock:
+        if _n_scripts > 0:
+            _n_scripts -= 1
+            if _n_scripts == 0:
+                _end_scripts()
+
+
+def _end_scripts():
+    """
+    Must be called with the lock acquired.
+    """
+    if sys.path is pathWrapper:
+        _SYS_PATH[:] = pathWrapper.base()
+    # A script may have replaced them
+    sys.path = _SYS_PATH
+    os.environ = _OS_ENVIRON
 
 
 def enable():
     sys.stdin = stdinWrapper
     sys.stdout = stdoutWrapper
     sys.stderr = stderrWrapper
+    sys.argv = argvWrapper
+    if pathFinder not in sys.meta_path:
+        sys.meta_path.insert(0, pathFinder)
+    for name, fn in _fileinput_replacements.items():
+        setattr(fileinput, name, fn)
+
 
 def disable():
+    global _n_scripts
     sys.stdin = _SYS_STDIN
     sys.stdout = _SYS_STDOUT
     sys.stderr = _SYS_STDERR
+    sys.argv = _SYS_ARGV
+    with _scripts_lock:
+        if _n_scripts > 0:
+            _n_scripts = 0
+            _end_scripts()
+    if pathFinder in sys.meta_path:
+        sys.meta_path.remove(pathFinder)
+    for name, fn in _fileinput_originals.items():
+        setattr(fileinput, name, fn)
@@ -1,10 +1,14 @@
 # coding: utf-8
 
 import os
+import sys
+import re
 import string
 import glob
+import fnmatch
 import logging
 import threading
+from collections import OrderedDict
 from StringIO import StringIO
 
 import pyparsing as pp
@@ -46,6 +50,26 @@ uq_word          : (WORD_CHARS)+ | '&3'
 
 _WORD_CHARS = string.digits + string.ascii_letters + r'''!#$%()*+,-./:=?@[]^_{}~'''
 
+# Character sets and patterns used by the hand-written parser (ShFastParser).
+# They mirror the definitions of the pyparsing grammar in ShParser.
+_PRINTABLES = ''.join(c for c in string.printable if c not in string.whitespace)
+_WORD_CHARS_SET = frozenset(_WORD_CHARS)
+_ESCAPABLE_CHARS_SET = frozenset(_PRINTABLES + ' ')
+_DQ_CHARS_SET = frozenset(_PRINTABLES.replace('`', ' ').replace('\\', ''))
+_OCT_DIGITS = '01234567'
+_HEX_DIGITS = '0123456789abcdefABCDEF'
+_WHITESPACES = ' \t\n\r'
+
+_RE_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+# $0-$9, $@, $#, $?, $$ | $NAME | ${NAME} (the closing brace is captured separately
+# so that an unterminated or malformed ${...} can be reported as bad substitution)
+_RE_ENVIRON_VAR = re.compile(r'\$(?:([0-9@#?$])|([A-Za-z_][A-Za-z0-9_]*)|\{([A-Za-z0-9_]*)(\}?))')
+_RE_QUOTED = {
+    '`': re.compile(r'`(?:[^`\n\r\\]|(?:\\.))*`'),
+    '"': re.compile(r'"(?:[^"\n\r\\]|(?:\\.))*"'),
+    "'": re.compile(r"'(?:[^'\n\r\\]|(?:\\.))*'"),
+}
+
 class ShAssignment(object):
     def __init__(self, identifier, value):
         self.identifier = identifier
@@ -145,97 +169,137 @@ class ShToken(object):
         ret = '{%s %d-%d %s %s}' % (self.tok, self.spos, self.epos, self.ttype, self.parts)
         return ret
 
+    def copy(self):
+        """
+        Deep copy of the token. The parts are either a list of tokens or, for
+        assignment words, a single token (the rhs value) with its own parts.
+        :rtype: ShToken
+        """
+        if isinstance(self.parts, ShToken):
+            parts = self.parts.copy()
+        elif self.parts is not None:
+            parts = [p.copy() for p in self.parts]
+        else:
+            parts = None
+        token = ShToken(self.tok, self.spos, self.ttype, parts)
+        token.epos = self.epos
+        return token
+
+
+# The current parse context of each thread. The shared grammar dispatches its
+# parse actions to it so that parsing is re-entrant across threads.
+_parse_context = threading.local()
+
+
+def _context_action(name):
+    """
+    Create a parse action that is dispatched to the named method of the
+    parse context currently active in the calling thread.
+    """
+    def action(s, pos, toks):
+        return getattr(_parse_context.current, name)(s, pos, toks)
+    return action
+
+
+def _build_grammar():
+    """
+    Build the pyparsing grammar for the command line and the special grammar
+    for strings inside double quotes.
+    :rtype: (pp.ParserElement, pp.ParserElement)
+    """
+    escaped = pp.Combine("\\" + pp.Word(pp.printables + ' ', exact=1)).setParseAction(
+        _context_action('escaped_action'))
+    escaped_oct = pp.Combine(
+        "\\" + pp.Word('01234567', max=3)
+    ).setParseAction(_context_action('escaped_oct_action'))
+    escaped_hex = pp.Combine(
+        "\\x" + pp.Word('0123456789abcdefABCDEF', exact=2)
+    ).setParseAction(_context_action('escaped_hex_action'))
+    # Some special uq_word is needed, e.g. &3 for file descriptor of Pythonista interactive prompt
+    uq_word = (pp.Literal('&3') | pp.Word(_WORD_CHARS)).setParseAction(_context_action('uq_word_action'))
+    bq_word = pp.QuotedString('`', escChar='\\', unquoteResults=False).setParseAction(
+        _context_action('bq_word_action'))
+    dq_word = pp.QuotedString('"', escChar='\\', unquoteResults=False).setParseAction(
+        _context_action('dq_word_action'))
+    sq_word = pp.QuotedString("'", escChar='\\', unquoteResults=False).setParseAction(
+        _context_action('sq_word_action'))
+    # The ^ operator means longest match (as opposed to | which means first match)
+    word = pp.Combine(pp.OneOrMore(escaped ^ escaped_oct ^ escaped_hex
+                                   ^ uq_word ^ bq_word ^ dq_word ^ sq_word))\
+        .setParseAction(_context_action('word_action'))
+
+    identifier = pp.Word(pp.alphas + '_', pp.alphas + pp.nums + '_').setParseAction(
+        _context_action('identifier_action'))
+    assign_op = pp.Literal('=').setParseAction(_context_action('assign_op_action'))
+    assignment_word = pp.Combine(identifier + assign_op + word).setParseAction(
+        _context_action('assignment_word_action'))
+
+    punctuator = pp.oneOf('; &').setParseAction(_context_action('punctuator_action'))
+    pipe_op = pp.Literal('|').setParseAction(_context_action('pipe_op_action'))
+    io_redirect_op = pp.oneOf('>> >').setParseAction(_context_action('io_redirect_op_action'))
+    io_redirect = (io_redirect_op + word)('io_redirect')
+
+    # The optional ' ' is a workaround to a possible bug in pyparsing.
+    # The position of cmd_word after cmd_prefix is always reported 1 character ahead
+    # of the correct value.
+    cmd_prefix = (pp.OneOrMore(assignment_word) + pp.Optional(' '))('cmd_prefix')
+    cmd_suffix = (pp.OneOrMore(word)('args') + pp.Optional(io_redirect)) ^ io_redirect
+
+    modifier = pp.oneOf('! \\')
+    cmd_word = (pp.Combine(pp.Optional(modifier) + word) ^ word)('cmd_word').setParseAction(
+        _context_action('cmd_word_action'))
+
+    simple_command = \
+        (cmd_prefix + pp.Optional(cmd_word) + pp.Optional(cmd_suffix)) \
+        | (cmd_word + pp.Optional(cmd_suffix))
+    simple_command = pp.Group(simple_command)
+
+    pipe_sequence = simple_command + pp.ZeroOrMore(pipe_op + simple_command)
+    pipe_sequence = pp.Group(pipe_sequence)
+
+    complete_command = pp.Optional(pipe_sequence
+                                   + pp.ZeroOrMore(punctuator + pipe_sequence)
+                                   + pp.Optional(punctuator))
+
+    # --- special parser for inside double quotes
+    uq_word_in_dq = pp.Word(pp.printables.replace('`', ' ').replace('\\', ''))\
+        .setParseAction(_context_action('uq_word_action'))
+    word_in_dq = pp.Combine(pp.OneOrMore(escaped ^ escaped_oct ^ escaped_hex ^ bq_word ^ uq_word_in_dq))
+    # ---
+
+    parser = complete_command.parseWithTabs().ignore(pp.pythonStyleComment)
+    parser_within_dq = word_in_dq.leaveWhitespace()
+    # Streamline now so the shared grammar is not modified lazily by the first parse
+    parser.streamline()
+    parser_within_dq.streamline()
+    return parser, parser_within_dq
+
 
 # noinspection PyProtectedMember
-class ShParser(object):
+class ShParseContext(object):
 
     """
-    Parse the command line input to provide basic semantic analysis.
-    The results will be further expanded by `ShExpander`.
+    State of a single parse with the pyparsing grammar. The grammar is shared by
+    all parsers and its parse actions work on the context of the current call.
     """
-    _NEXT_WORD_CMD = '_NEXT_WORD_CMD'
-    _NEXT_WORD_VAL = '_NEXT_WORD_VAL'  # rhs of assignment
-    _NEXT_WORD_FILE = '_NEXT_WORD_FILE'
 
     def __init__(self, debug=False):
-
         self.debug = debug
         self.logger = logging.getLogger('StaSh.Parser')
-
-        escaped = pp.Combine("\\" + pp.Word(pp.printables + ' ', exact=1)).setParseAction(self.escaped_action)
-        escaped_oct = pp.Combine(
-            "\\" + pp.Word('01234567', max=3)
-        ).setParseAction(self.escaped_oct_action)
-        escaped_hex = pp.Combine(
-            "\\x" + pp.Word('0123456789abcdefABCDEF', exact=2)
-        ).setParseAction(self.escaped_hex_action)
-        # Some special uq_word is needed, e.g. &3 for file descriptor of Pythonista interactive prompt
-        uq_word = (pp.Literal('&3') | pp.Word(_WORD_CHARS)).setParseAction(self.uq_word_action)
-        bq_word = pp.QuotedString('`', escChar='\\', unquoteResults=False).setParseAction(self.bq_word_action)
-        dq_word = pp.QuotedString('"', escChar='\\', unquoteResults=False).setParseAction(self.dq_word_action)
-        sq_word = pp.QuotedString("'", escChar='\\', unquoteResults=False).setParseAction(self.sq_word_action)
-        # The ^ operator means longest match (as opposed to | which means first match)
-        word = pp.Combine(pp.OneOrMore(escaped ^ escaped_oct ^ escaped_hex
-                                       ^ uq_word ^ bq_word ^ dq_word ^ sq_word))\
-            .setParseAction(self.word_action)
-
-        identifier = pp.Word(pp.alphas + '_', pp.alphas + pp.nums + '_').setParseAction(self.identifier_action)
-        assign_op = pp.Literal('=').setParseAction(self.assign_op_action)
-        assignment_word = pp.Combine(identifier + assign_op + word).setParseAction(self.assignment_word_action)
-
-        punctuator = pp.oneOf('; &').setParseAction(self.punctuator_action)
-        pipe_op = pp.Literal('|').setParseAction(self.pipe_op_action)
-        io_redirect_op = pp.oneOf('>> >').setParseAction(self.io_redirect_op_action)
-        io_redirect = (io_redirect_op + word)('io_redirect')
-
-        # The optional ' ' is a workaround to a possible bug in pyparsing.
-        # The position of cmd_word after cmd_prefix is always reported 1 character ahead
-        # of the correct value.
-        cmd_prefix = (pp.OneOrMore(assignment_word) + pp.Optional(' '))('cmd_prefix')
-        cmd_suffix = (pp.OneOrMore(word)('args') + pp.Optional(io_redirect)) ^ io_redirect
-
-        modifier = pp.oneOf('! \\')
-        cmd_word = (pp.Combine(pp.Optional(modifier) + word) ^ word)('cmd_word').setParseAction(self.cmd_word_action)
-
-        simple_command = \
-            (cmd_prefix + pp.Optional(cmd_word) + pp.Optional(cmd_suffix)) \
-            | (cmd_word + pp.Optional(cmd_suffix))
-        simple_command = pp.Group(simple_command)
-
-        pipe_sequence = simple_command + pp.ZeroOrMore(pipe_op + simple_command)
-        pipe_sequence = pp.Group(pipe_sequence)
-
-        complete_command = pp.Optional(pipe_sequence
-                                       + pp.ZeroOrMore(punctuator + pipe_sequence)
-                                       + pp.Optional(punctuator))
-
-        # --- special parser for inside double quotes
-        uq_word_in_dq = pp.Word(pp.printables.replace('`', ' ').replace('\\', ''))\
-            .setParseAction(self.uq_word_action)
-        word_in_dq = pp.Combine(pp.OneOrMore(escaped ^ escaped_oct ^ escaped_hex ^ bq_word ^ uq_word_in_dq))
-        # ---
-
-        self.parser = complete_command.parseWithTabs().ignore(pp.pythonStyleComment)
-        self.parser_within_dq = word_in_dq.leaveWhitespace()
-        self.next_word_type = ShParser._NEXT_WORD_CMD
-        self.tokens = []
-        self.parts = []
-
-    def parse(self, line):
-        if self.debug:
-            self.logger.debug('line: %s' % repr(line))
         self.next_word_type = ShParser._NEXT_WORD_CMD
         self.tokens = []
         self.parts = []
-        parsed = self.parser.parseString(line, parseAll=True)
-        return self.tokens, parsed
 
-    def parse_within_dq(self, s):
-        """ Take the input string as if it is inside a pair of double quotes
+    def run(self, parser, s):
         """
-        self.parts = []
-        parsed = self.parser_within_dq.parseString(s, parseAll=True)
-        return self.parts, parsed
+        Parse the given string with the given grammar in this context.
+        """
+        saved_context = getattr(_parse_context, 'current', None)
+        _parse_context.current = self
+        try:
+            return parser.parseString(s, parseAll=True)
+        finally:
+            _parse_context.current = saved_context
 
     def identifier_action(self, s, pos, toks):
         """ This function is only needed for debug """
@@ -344,6 +408,342 @@ class ShParser(object):
         self.parts.append(ShToken(tok, pos, ttype))
 
 
+# noinspection PyProtectedMember
+class ShParser(object):
+
+    """
+    Parse the command line input to provide basic semantic analysis.
+    The results will be further expanded by `ShExpander`.
+    """
+    _NEXT_WORD_CMD = '_NEXT_WORD_CMD'
+    _NEXT_WORD_VAL = '_NEXT_WORD_VAL'  # rhs of assignment
+    _NEXT_WORD_FILE = '_NEXT_WORD_FILE'
+
+    def __init__(self, debug=False, cache_size=64, engine='pyparsing'):
+
+        self.debug = debug
+        self.logger = logging.getLogger('StaSh.Parser')
+
+        # The hand-written parser is used in place of the pyparsing grammar if selected
+        self.engine = engine
+        self.fast_parser = ShFastParser(debug=debug) if engine == 'fast' else None
+
+        # LRU cache of parsed results keyed by the line string
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # The grammar is built once per process and shared by all parsers
+        self.parser = _PARSER
+        self.parser_within_dq = _PARSER_WITHIN_DQ
+
+    def parse(self, line):
+        if self.debug:
+            self.logger.debug('line: %s' % repr(line))
+
+        with self._cache_lock:
+            entry = self._cache.pop(line, None)
+            if entry is not None:
+                self._cache[line] = entry  # move to the most recently used end
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+        if entry is None:
+            if self.fast_parser:
+                entry = self.fast_parser.parse(line)
+            else:
+                context = ShParseContext(debug=self.debug)
+                parsed = context.run(self.parser, line)
+                entry = (context.tokens, parsed)
+            if self.cache_size > 0:
+                with self._cache_lock:
+                    self._cache[line] = entry
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+
+        # Callers may modify tokens in place (e.g. history and alias substitution).
+        # Always hand out fresh copies so the cached entries stay intact.
+        # The parsed results are only read and can be shared.
+        tokens, parsed = entry
+        return [t.copy() for t in tokens], parsed
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self.cache_hits = self.cache_misses = 0
+
+    def parse_within_dq(self, s):
+        """ Take the input string as if it is inside a pair of double quotes
+        """
+        if self.fast_parser:
+            return self.fast_parser.parse_within_dq(s)
+        context = ShParseContext(debug=self.debug)
+        parsed = context.run(self.parser_within_dq, s)
+        return context.parts, parsed
+
+
+_PARSER, _PARSER_WITHIN_DQ = _build_grammar()
+
+
+class ShParsedCommand(object):
+    """
+    Parsed structure of a simple command produced by `ShFastParser`. It
+    provides the same named groups as the pyparsing results of `ShParser`.
+    """
+    def __init__(self):
+        self.cmd_prefix = []
+        self.cmd_word = ''
+        self.args = []
+        self.io_redirect = []
+
+    def __repr__(self):
+        return 'cmd_prefix: %s, cmd_word: %s, args: %s, io_redirect: %s' % \
+               (self.cmd_prefix, self.cmd_word, self.args, self.io_redirect)
+
+
+# noinspection PyProtectedMember
+class ShFastParser(object):
+
+    """
+    A hand-written single pass parser as a faster alternative to the pyparsing
+    grammar of `ShParser`. It scans the line from left to right without any
+    backtracking and produces the same tokens and the same parsed structure,
+    i.e. a list of pipe sequences separated by punctuators, each of which is a
+    list of `ShParsedCommand` separated by pipe operators.
+    """
+
+    _QUOTED_TTYPES = {
+        '`': ShToken._BQ_WORD,
+        '"': ShToken._DQ_WORD,
+        "'": ShToken._SQ_WORD,
+    }
+
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.logger = logging.getLogger('StaSh.FastParser')
+
+    def parse(self, line):
+        tokens = []
+        parsed = []
+        len_line = len(line)
+
+        pos = self._skip(line, 0)
+        while pos < len_line:
+            pipe_sequence = []
+            pos = self._skip(line, self._pipe_sequence(line, pos, tokens, pipe_sequence))
+            parsed.append(pipe_sequence)
+
+            if pos < len_line and line[pos] in ';&':
+                tokens.append(ShToken(line[pos], pos, ShToken._PUNCTUATOR))
+                parsed.append(line[pos])
+                pos = self._skip(line, pos + 1)
+
+            elif pos < len_line:
+                self._error(line, pos, 'expected end of text')
+
+        return tokens, parsed
+
+    def parse_within_dq(self, s):
+        """ Take the input string as if it is inside a pair of double quotes
+        """
+        s = s.expandtabs()  # consistent with pyparsing which expands tabs by default
+        parts = []
+        len_s = len(s)
+        pos = 0
+        while pos < len_s:
+            c = s[pos]
+            if c in _DQ_CHARS_SET:
+                end = pos + 1
+                while end < len_s and s[end] in _DQ_CHARS_SET:
+                    end += 1
+                ttype = ShToken._UQ_WORD
+            elif c == '\\':
+                end, ttype = self._escaped(s, pos)
+            elif c == '`':
+                m = _RE_QUOTED[c].match(s, pos)
+                end, ttype = (m.end(), ShToken._BQ_WORD) if m else (None, None)
+            else:
+                end = None
+
+            if end is None:
+                break
+            parts.append(ShToken(s[pos:end], pos, ttype))
+            pos = end
+
+        if not parts or s[pos:].strip(_WHITESPACES) != '':
+            self._error(s, pos, 'invalid string inside double quotes')
+
+        return parts, parts
+
+    def _error(self, line, pos, msg):
+        if self.debug:
+            self.logger.debug('%s at char %d: %s' % (msg, pos, repr(line)))
+        raise pp.ParseException(line, pos, msg)
+
+    @staticmethod
+    def _skip(line, pos):
+        """
+        Skip whitespaces and comments. A comment starts with # at a word
+        boundary and extends to the end of the line.
+        """
+        len_line = len(line)
+        while pos < len_line:
+            c = line[pos]
+            if c in _WHITESPACES:
+                pos += 1
+            elif c == '#':
+                pos = line.find('\n', pos)
+                if pos == -1:
+                    return len_line
+            else:
+                break
+        return pos
+
+    def _pipe_sequence(self, line, pos, tokens, pipe_sequence):
+        pos = self._simple_command(line, pos, tokens, pipe_sequence)
+        while True:
+            pos_pipe = self._skip(line, pos)
+            if pos_pipe < len(line) and line[pos_pipe] == '|':
+                tokens.append(ShToken('|', pos_pipe, ShToken._PIPE_OP))
+                pipe_sequence.append('|')
+                pos = self._simple_command(line, self._skip(line, pos_pipe + 1), tokens, pipe_sequence)
+            else:
+                return pos
+
+    def _simple_command(self, line, pos, tokens, pipe_sequence):
+        simple_command = ShParsedCommand()
+        len_line = len(line)
+
+        # cmd_prefix
+        while True:
+            end = self._assignment_word(line, pos, tokens)
+            if end is None:
+                break
+            simple_command.cmd_prefix.append(tokens[-1].tok)
+            pos = self._skip(line, end)
+
+        # cmd_word
+        end = self._cmd_word(line, pos, tokens)
+        if end is not None:
+            simple_command.cmd_word = tokens[-1].tok
+            pos = self._skip(line, end)
+
+            # args
+            while True:
+                word = self._word(line, pos)
+                if word is None:
+                    break
+                end, parts = word
+                tokens.append(ShToken(line[pos:end], pos, ShToken._WORD, parts))
+                simple_command.args.append(tokens[-1].tok)
+                pos = self._skip(line, end)
+
+        elif not simple_command.cmd_prefix:
+            self._error(line, pos, 'expected command')
+
+        # io_redirect
+        if pos < len_line and line[pos] == '>':
+            operator = '>>' if line.startswith('>>', pos) else '>'
+            tokens.append(ShToken(operator, pos, ShToken._IO_REDIRECT_OP))
+            pos = self._skip(line, pos + len(operator))
+            word = self._word(line, pos)
+            if word is None:
+                self._error(line, pos, 'expected filename')
+            end, parts = word
+            tokens.append(ShToken(line[pos:end], pos, ShToken._FILE, parts))
+            simple_command.io_redirect = [operator, tokens[-1].tok]
+            pos = end
+
+        pipe_sequence.append(simple_command)
+        return pos
+
+    def _assignment_word(self, line, pos, tokens):
+        m = _RE_IDENTIFIER.match(line, pos)
+        if m is None or not line.startswith('=', m.end()):
+            return None
+        pos_value = m.end() + 1
+        word = self._word(line, pos_value)
+        if word is None:
+            return None
+        end, parts = word
+        value = ShToken(line[pos_value:end], pos_value, ShToken._WORD, parts)
+        tokens.append(ShToken(line[pos:end], pos, ShToken._ASSIGN_WORD, value))
+        return end
+
+    def _cmd_word(self, line, pos, tokens):
+        word = self._word(line, pos)
+        # A leading modifier is not part of the word. The longer match wins and
+        # a tie favours the modifier form.
+        if pos < len(line) and line[pos] in '!\\':
+            word_modified = self._word(line, pos + 1)
+            if word_modified is not None and (word is None or word_modified[0] >= word[0]):
+                word = word_modified
+        if word is None:
+            return None
+        end, parts = word
+        tokens.append(ShToken(line[pos:end], pos, ShToken._CMD, parts))
+        return end
+
+    def _word(self, line, pos):
+        """
+        Scan a word, which consists of one or more adjacent parts.
+        :return: The end location of the word and its parts or None if no word.
+        :rtype: (int, [ShToken]) | None
+        """
+        parts = []
+        len_line = len(line)
+        while pos < len_line:
+            c = line[pos]
+            if c in _WORD_CHARS_SET:
+                end = pos + 1
+                while end < len_line and line[end] in _WORD_CHARS_SET:
+                    end += 1
+                ttype = ShToken._UQ_WORD
+            elif c == '&' and line.startswith('&3', pos):
+                end, ttype = pos + 2, ShToken._UQ_WORD
+            elif c == '\\':
+                end, ttype = self._escaped(line, pos)
+            elif c in self._QUOTED_TTYPES:
+                m = _RE_QUOTED[c].match(line, pos)
+                end, ttype = (m.end(), self._QUOTED_TTYPES[c]) if m else (None, None)
+            else:
+                end = None
+
+            if end is None:
+                break
+            parts.append(ShToken(line[pos:end], pos, ttype))
+            pos = end
+
+        return (pos, parts) if parts else None
+
+    @staticmethod
+    def _escaped(line, pos):
+        """
+        Scan an escape sequence starting at the backslash. The longest match of
+        hex, oct and plain escape wins. A tie favours the plain escape.
+        :rtype: (int, str) | (None, None)
+        """
+        nxt = line[pos + 1: pos + 2]
+        if nxt == 'x' and len(line[pos + 2: pos + 4]) == 2 \
+                and all(c in _HEX_DIGITS for c in line[pos + 2: pos + 4]):
+            return pos + 4, ShToken._ESCAPED_HEX
+
+        end = pos + 1
+        while end < len(line) and end < pos + 4 and line[end] in _OCT_DIGITS:
+            end += 1
+        # An oct escape followed by a fourth digit is not a match at all
+        if end > pos + 2 and not (end < len(line) and line[end] in _OCT_DIGITS):
+            return end, ShToken._ESCAPED_OCT
+
+        if nxt != '' and nxt in _ESCAPABLE_CHARS_SET:
+            return pos + 2, ShToken._ESCAPED
+
+        return None, None
+
+
 # noinspection PyProtectedMember
 class ShExpander(object):
 
@@ -387,6 +787,9 @@ class ShExpander(object):
 
             # Due to the generator change, complete_command is redundant and removed
             pipe_sequence = ShPipeSequence()
+            # Directory listings for pathname expansion. They are only shared within a
+            # pipe sequence because previous pipe sequences may have changed the files.
+            listdir_cache = {}
 
             for isc in range(0, len(pseq), 2):
                 sc = pseq[isc]
@@ -395,13 +798,13 @@ class ShExpander(object):
                 for _ in sc.cmd_prefix:
                     t = tokens[idxt]
                     ident = t.tok[0: len(t.tok) - len(t.parts.tok) - 1]
-                    val = ' '.join(self.expand_word(t.parts))
+                    val = ' '.join(self.expand_word(t.parts, listdir_cache))
                     simple_command.assignments.append(ShAssignment(ident, val))
                     idxt += 1
 
                 if sc.cmd_word:
                     t = tokens[idxt]
-                    fields = self.expand_word(t)
+                    fields = self.expand_word(t, listdir_cache)
                     simple_command.cmd_word = fields[0]
 
                     if len(fields) > 1:
@@ -410,13 +813,13 @@ class ShExpander(object):
 
                 for _ in sc.args:
                     t = tokens[idxt]
-                    simple_command.args.extend(self.expand_word(t))
+                    simple_command.args.extend(self.expand_word(t, listdir_cache))
                     idxt += 1
 
                 if sc.io_redirect:
                     io_op = tokens[idxt].tok
                     t = tokens[idxt + 1]
-                    fields = self.expand_word(t)
+                    fields = self.expand_word(t, listdir_cache)
                     if len(fields) > 1:
                         raise ShSingleExpansionRequired('multiple IO file: %s' % fields)
                     simple_command.io_redirect = ShIORedirect(io_op, fields[0])
@@ -479,14 +882,27 @@ class ShExpander(object):
             tokens, parsed = self.stash.runtime.parser.parse(line)
         return tokens, parsed
 
-    def expand_word(self, word):
+    def expand_word(self, word, listdir_cache=None):
+        """
+        Expand the given word into fields.
+
+        :param ShToken word: The word to expand
+        :param dict listdir_cache: Directory listings shared by pathname expansion
+        :rtype: [str]
+        """
         if self.debug:
             self.logger.debug(word.tok)
 
+        if listdir_cache is None:
+            listdir_cache = {}
+
         words_expanded = []
         words_expanded_globable = []
+        # Whether or not each field has any unescaped wildcards
+        words_has_magic = []
 
         w_expanded = w_expanded_globable = ''
+        w_has_magic = False
         for i, p in enumerate(word.parts):
             if p.ttype == ShToken._ESCAPED:
                 ex, exg = self.expand_escaped(p.tok)
@@ -508,13 +924,18 @@ class ShExpander(object):
 
             elif p.ttype == ShToken._BQ_WORD:
                 ret = self.expand_bq_word(p.tok)
+                # The substituted command may have changed the files
+                listdir_cache.clear()
                 fields = ret.split()
                 if len(fields) > 1:
                     words_expanded.append(w_expanded + fields[0])
                     words_expanded.extend(fields[1:-1])
                     words_expanded_globable.append(w_expanded_globable + fields[0])
                     words_expanded_globable.extend(fields[1:-1])
+                    words_has_magic.append(w_has_magic or glob.has_magic(fields[0]))
+                    words_has_magic.extend(glob.has_magic(f) for f in fields[1:-1])
                     w_expanded = w_expanded_globable = ''
+                    w_has_magic = False
                     ex = exg = fields[-1]
                 else:
                     ex = exg = ret
@@ -523,20 +944,63 @@ class ShExpander(object):
 
             w_expanded += ex
             w_expanded_globable += exg
+            # Escaped wildcards are in the form of [*] which does not need a glob.
+            # Without any unescaped wildcards, the globbed result is always the word itself.
+            if ex == exg and not w_has_magic:
+                w_has_magic = glob.has_magic(exg)
 
         words_expanded.append(w_expanded)
         words_expanded_globable.append(w_expanded_globable)
+        words_has_magic.append(w_has_magic)
 
         fields = []
-        for w_expanded, w_expanded_globable in zip(words_expanded, words_expanded_globable):
-            w_expanded_globbed = glob.glob(w_expanded_globable)
-            if w_expanded_globbed:
-                fields.extend(w_expanded_globbed)
-            else:
-                fields.append(w_expanded)
+        for w_expanded, w_expanded_globable, has_magic in zip(words_expanded,
+                                                               words_expanded_globable,
+                                                               words_has_magic):
+            if has_magic:
+                w_expanded_globbed = self.expand_pathname(w_expanded_globable, listdir_cache)
+                if w_expanded_globbed:
+                    fields.extend(w_expanded_globbed)
+                    continue
+            fields.append(w_expanded)
 
         return fields
 
+    def expand_pathname(self, pattern, listdir_cache):
+        """
+        Same as glob.glob except that listings of directories are read from
+        and saved to the given cache.
+
+        :param str pattern: The pathname pattern
+        :param dict listdir_cache: Directory listings keyed by directory name
+        :rtype: [str]
+        """
+        dirname, basename = os.path.split(pattern)
+        # Only the common case of wildcards in the last path component is cached
+        if glob.has_magic(dirname) or not glob.has_magic(basename):
+            return glob.glob(pattern)
+
+        listdir_key = dirname or os.curdir
+        if isinstance(basename, unicode) and not isinstance(listdir_key, unicode):
+            listdir_key = unicode(listdir_key, sys.getfilesystemencoding() or sys.getdefaultencoding())
+
+        names = listdir_cache.get(listdir_key)
+        if names is None:
+            try:
+                names = os.listdir(listdir_key)
+            except os.error:
+                names = []
+            listdir_cache[listdir_key] = names
+
+        if basename[0] != '.':
+            names = [name for name in names if name[0] != '.']
+        names = fnmatch.filter(names, basename)
+
+        if dirname:
+            return [os.path.join(dirname, name) for name in names]
+        else:
+            return names
+
     def expand_escaped(self, tok):
         # TODO: more escape characters, e.g. ESC
         if self.debug:
@@ -614,90 +1078,51 @@ class ShExpander(object):
         if self.debug:
             self.logger.debug(s)
 
-        _, current_state = self.stash.runtime.get_current_worker_and_state()
-        saved_environ = os.environ
-        try:
-            os.environ = current_state.environ
-            s = os.path.expanduser(s)
-            # Command substitution is done by bq_word_action
-            # Pathname expansion (glob) is done in word_action
-        finally:
-            os.environ = saved_environ
-        return s
+        # The worker's own HOME is used instead of swapping the global os.environ,
+        # which is not safe when multiple workers expand at the same time.
+        # Command substitution is done by bq_word_action
+        # Pathname expansion (glob) is done in word_action
+        if s.startswith('~') and (len(s) == 1 or s[1] == '/'):
+            _, current_state = self.stash.runtime.get_current_worker_and_state()
+            home = current_state.environ.get('HOME')
+            if home is not None:
+                return (home.rstrip('/') + s[1:]) or '/'
+        return os.path.expanduser(s)
+
+    def expandvars(self, s, environ=None):
+        """
+        Substitute $NAME, ${NAME} and the special parameters ($0-$9, $@, $#, $?, $$)
+        in a single pass.
 
-    def expandvars(self, s):
+        :param str s: The string to expand
+        :param dict environ: Variables to read from. Default to the environ of the current worker.
+        :rtype: str
+        """
         if self.debug:
             self.logger.debug(s)
 
-        _, current_state = self.stash.runtime.get_current_worker_and_state()
-        saved_environ = os.environ
-        try:
-            os.environ = current_state.environ
-
-            state = 'a'
-            es = ''
-            varname = ''
-            for nextchar in s:
-
-                if state == 'a':
-                    if nextchar == '$':
-                        state = '$'
-                        varname = ''
-                    else:
-                        es += nextchar
-
-                elif state == '$':
-                    if varname == '':
-                        if nextchar == '{':
-                            state = '{'
-                        elif nextchar in '0123456789@#?':
-                            es += str(os.environ.get(nextchar, ''))
-                            state = 'a'
-                        elif nextchar == '$':
-                            es += str(threading.currentThread()._Thread__ident)
-                            state = 'a'
-                        elif nextchar in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz':
-                            varname += nextchar
-                        else:
-                            es += '$' + nextchar
-                            state = 'a'
-
-                    else:
-                        if nextchar in '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz':
-                            varname += nextchar
-                        else:
-                            if self.debug:
-                                self.logger.debug('environ sub: %s\n' % varname)
-                            es += os.environ.get(varname, '') + nextchar
-                            state = 'a'
-
-                elif state == '{':
-                    if nextchar == '}':
-                        if varname == '':
-                            raise ShBadSubstitution('bad environ substitution')
-                        else:
-                            es += os.environ.get(varname, '')
-                            state = 'a'
-                    elif nextchar in '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz':
-                        varname += nextchar
-                    else:
-                        raise ShBadSubstitution('bad environ substitution')
-
-                else:
-                    raise ShInternalError('syntax error in environ substitution')
-
-            if state == '$':
-                if varname != '':
-                    if self.debug:
-                        self.logger.debug('environ sub: %s\n' % varname)
-                    es += os.environ.get(varname, '')
-                else:
-                    es += '$'
-            elif state == '{':
-                raise ShBadSubstitution('bad environ substitution')
+        if '$' not in s:
+            return s
+
+        if environ is None:
+            _, current_state = self.stash.runtime.get_current_worker_and_state()
+            environ = current_state.environ
+
+        def repl(m):
+            special, varname, braced_varname, closing_brace = m.groups()
+            if special is not None:
+                if special == '$':
+                    return str(threading.currentThread()._Thread__ident)
+                return str(environ.get(special, ''))
+            if varname is None:
+                if braced_varname == '' or closing_brace == '':
+                    raise ShBadSubstitution('bad environ substitution')
+                varname = braced_varname
+            if self.debug:
+                self.logger.debug('environ sub: %s\n' % varname)
+            return environ.get(varname, '')
 
-        finally:
-            os.environ = saved_environ
+        es = _RE_ENVIRON_VAR.sub(repl, s)
 
         if s != es:
             if self.debug:
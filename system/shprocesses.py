@@ -0,0 +1,377 @@
+# coding: utf-8
+"""
+Run python scripts in separate processes so they do not share the interpreter,
+and its global interpreter lock, with other commands.
+"""
+import os
+import sys
+import errno
+import select
+import signal
+import marshal
+import threading
+import traceback
+
+try:
+    import multiprocessing
+except ImportError:  # processes cannot be started, e.g. in Pythonista
+    multiprocessing = None
+else:
+    if not hasattr(os, 'fork'):  # scripts run in processes forked by the pool processes
+        multiprocessing = None
+
+
+class ShProcessOutput(object):
+    """
+    The stdout or stderr of a script running in a pool process. Writes are sent
+    to the shell line by line.
+    """
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.softspace = 0
+        self.encoding = 'utf8'
+        self._chunks = []
+        self._size = 0
+
+    @property
+    def closed(self):
+        return False
+
+    def isatty(self):
+        return False
+
+    def write(self, s):
+        self._chunks.append(s)
+        self._size += len(s)
+        if self._size >= 4096 or '\n' in s:
+            self.flush()
+
+    def writelines(self, s_list):
+        self.write(''.join(s_list))
+
+    def flush(self):
+        if self._chunks:
+            self.conn.send((self.name, ''.join(self._chunks)))
+            self._chunks = []
+            self._size = 0
+
+    def close(self):
+        self.flush()
+
+
+class ShProcessInput(object):
+    """
+    The stdin of a script running in a pool process. Each read is requested from
+    the shell, which reads from the actual stdin of the command.
+    """
+
+    def __init__(self, conn, outputs):
+        self.conn = conn
+        self.outputs = outputs
+        self.encoding = 'utf8'
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+    @property
+    def closed(self):
+        return False
+
+    def isatty(self):
+        return False
+
+    def _request(self, method, *args):
+        # Prompts are shown before waiting for input
+        for output in self.outputs:
+            output.flush()
+        self.conn.send(('stdin', method, args))
+        return self.conn.recv()
+
+    def read(self, size=-1):
+        return self._request('read', size)
+
+    def readline(self, size=-1):
+        return self._request('readline', size)
+
+    def readlines(self, sizehint=-1):
+        return self._request('readlines', sizehint)
+
+    def close(self):
+        pass
+
+
+def _run_script(conn, task):
+    """
+    Run a script in the current process.
+    :return: The return value and the error message if the script raised
+    """
+    code, filename, argv, environ, cwd, sys_path, py_traceback = task
+
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(environ)
+    sys.path[:] = sys_path
+    sys.argv = argv
+    sys.stdout = ShProcessOutput(conn, 'stdout')
+    sys.stderr = ShProcessOutput(conn, 'stderr')
+    sys.stdin = ShProcessInput(conn, (sys.stdout, sys.stderr))
+
+    namespace = {'__name__': '__main__', '__file__': filename, '_stash': None}
+    err_msg = None
+    try:
+        exec marshal.loads(code) in namespace, namespace
+        return_value = 0
+
+    except SystemExit as e:
+        return_value = e.code
+
+    except Exception:
+        return_value = 1
+        etype, evalue, tb = sys.exc_info()
+        err_msg = '%s: %s\n' % (repr(etype), evalue)
+        if py_traceback:
+            traceback.print_exception(etype, evalue, tb)
+
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    return return_value, err_msg
+
+
+def _fork_script(conn, task):
+    """
+    Run a script in a new process forked from the current pool process, relay its
+    messages over the connection to the shell and report how it ended. A request
+    to kill the script ends the process.
+    """
+    script_conn, child_conn = multiprocessing.Pipe()
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        script_conn.close()
+        exit_code = 1
+        try:
+            return_value, err_msg = _run_script(child_conn, task)
+            child_conn.send(('exit', return_value, err_msg))
+            exit_code = 0
+        finally:
+            os._exit(exit_code)
+
+    child_conn.close()
+    ended = False
+    try:
+        while True:
+            try:
+                readable, _, _ = select.select([script_conn, conn], [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if script_conn in readable:
+                try:
+                    msg = script_conn.recv()
+                except EOFError:  # the process has ended
+                    ended = True
+                    break
+                conn.send(msg)
+            if conn in readable:
+                try:
+                    msg = conn.recv()
+                except EOFError:  # the shell has ended
+                    msg = ('kill',)
+                if msg[0] == 'kill':
+                    os.kill(pid, signal.SIGTERM)
+                else:
+                    script_conn.send(msg[1])
+    finally:
+        script_conn.close()
+        if not ended:
+            os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+    conn.send(('ended', os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)))
+
+
+def _serve(conn):
+    """
+    Main function of a pool process. Run the scripts sent over the connection
+    till it is closed, each one in a new process. The pool process itself never
+    runs a script and has a single thread, hence it can safely fork.
+    """
+    # The process is forked from the shell and must not dispatch to its workers
+    from .shiowrapper import disable
+    disable()
+    # The pool process and the processes of its scripts are ended together
+    os.setpgrp()
+
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, IOError):
+            return
+        if task[0] == 'run':
+            try:
+                _fork_script(conn, task[1:])
+            except IOError:  # the shell has ended
+                return
+        # Otherwise it is a kill request that came after the script had ended
+
+
+class ShProcessPool(object):
+    """
+    Pre-forked processes that run python scripts. A script gets its arguments,
+    environ, current directory and sys.path from the worker that runs it, and
+    its stdio are streamed through the worker's own streams.
+
+    The pool processes are forked when the pool is created, which is done by the
+    main thread at start-up. Each script runs in a new process forked by a pool
+    process, so scripts do not see the modules and globals of each other, and
+    the shell, which runs many threads, is not forked again.
+
+    Scripts in a pool process cannot use the shell, i.e. _stash is None.
+
+    At most size scripts run at the same time, the others wait for a pool process.
+    A pool process that dies, e.g. killed from outside, is not replaced. Once none
+    is left, the commands run in threads again.
+
+    :param int size: Number of processes in the pool.
+    """
+
+    # Waits for the script are done in steps so that the waiting worker can still be killed
+    wait_interval = 0.1
+    # Time that the script of a killed worker has to end, otherwise its pool process is ended
+    kill_timeout = 1.0
+
+    def __init__(self, size=2):
+        self.size = size
+        self._idle = []
+        self._cond = threading.Condition()
+        self.n_processes = 0  # number of pool processes alive
+        for _ in range(size):
+            self._idle.append(self._new_process())
+
+    def __del__(self):
+        self.shutdown()
+
+    def _new_process(self):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_serve, args=(child_conn,))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self.n_processes += 1
+        return process, conn
+
+    def _take(self):
+        """
+        :return: An idle pool process and its connection, None if none is left
+        """
+        with self._cond:
+            while not self._idle:
+                if self.n_processes == 0:
+                    return None
+                self._cond.wait(self.wait_interval)
+            return self._idle.pop()
+
+    def _put_back(self, process, conn):
+        with self._cond:
+            self._idle.append((process, conn))
+            self._cond.notify()
+
+    def _end_process(self, process, conn):
+        """
+        End a pool process together with the process of its script.
+        """
+        conn.close()
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:  # already ended
+            pass
+        process.join()
+        with self._cond:
+            self.n_processes -= 1
+            self._cond.notify_all()
+
+    def _kill_script(self, process, conn):
+        """
+        Kill the script that a pool process is running. The pool process is put back
+        once the script has ended, or ended itself if the script does not end in time.
+        """
+        try:
+            conn.send(('kill',))
+            while conn.poll(self.kill_timeout):
+                if conn.recv()[0] == 'ended':
+                    self._put_back(process, conn)
+                    return
+        except (EOFError, IOError):
+            pass
+        self._end_process(process, conn)
+
+    def shutdown(self):
+        """
+        End all idle processes.
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for process, conn in idle:
+            self._end_process(process, conn)
+
+    def run_script(self, code, filename, argv, environ, cwd, sys_path, ins, outs, errs,
+                   py_traceback=False):
+        """
+        Run a script in a pool process and wait for it to finish.
+
+        :param code code: Compiled code of the script
+        :param str filename: Absolute path of the script
+        :param list argv: sys.argv of the script
+        :param dict environ: os.environ of the script, with string values only
+        :param str cwd: Current directory of the script
+        :param list sys_path: sys.path of the script
+        :param ins: The input
+        :param outs: The output
+        :param errs: The error output
+        :param bool py_traceback: Whether or not to print the traceback if the script raises
+        :return: The return value and the error message if the script raised
+        :rtype: (int, str)
+        """
+        taken = self._take()
+        if taken is None:
+            raise IOError('no process is left in the process pool')
+        process, conn = taken
+        result = None
+        try:
+            conn.send(('run', marshal.dumps(code), filename, argv, environ, cwd, sys_path, py_traceback))
+            while True:
+                if not conn.poll(self.wait_interval):
+                    continue
+                try:
+                    msg = conn.recv()
+                except EOFError:  # the pool process has died
+                    return 1, 'the process running the script has ended\n'
+                if msg[0] == 'stdout':
+                    outs.write(msg[1])
+                elif msg[0] == 'stderr':
+                    errs.write(msg[1])
+                elif msg[0] == 'stdin':
+                    conn.send(('stdin', getattr(ins, msg[1])(*msg[2])))
+                elif msg[0] == 'exit':
+                    result = msg[1], msg[2]
+                else:  # the process of the script has ended, e.g. also by os._exit
+                    self._put_back(process, conn)
+                    process = None
+                    return result or (msg[1], None)
+        finally:
+            # The worker is killed, the output is a broken pipe or the pool process has died
+            if process is not None:
+                if process.is_alive():
+                    self._kill_script(process, conn)
+                else:
+                    self._end_process(process, conn)
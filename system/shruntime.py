@@ -1,8 +1,13 @@
 # coding: utf-8
 import os
+import errno
 import sys
+import imp
+import hashlib
+import marshal
 import logging
 import threading
+from collections import OrderedDict
 from StringIO import StringIO
 
 import pyparsing as pp
@@ -19,9 +24,13 @@ from .shcommon import ShBadSubstitution, ShInternalError, ShIsDirectory, \
     ShFileNotFound, ShEventNotFound, ShNotExecutable
 # noinspection PyProtectedMember
 from .shcommon import _STASH_ROOT, _STASH_HISTORY_FILE, _SYS_STDOUT, _SYS_STDERR
-from .shcommon import is_binary_file
+from .shcommon import IN_PYTHONISTA, is_binary_file
+from .shio import ShPipe, ShBufferedOutput
+from .shiowrapper import begin_script, end_script
 from .shparsers import ShPipeSequence
-from .shthreads import ShBaseThread, ShTracedThread, ShCtypesThread, ShState, ShWorkerRegistry
+from .shprocesses import ShProcessPool, multiprocessing
+from .shthreads import ShTracedThread, ShCtypesThread, ShState, ShWorkerRegistry, ShWorkerPool, \
+    _WORKER_LOCAL
 
 
 # Default .stashrc file
@@ -38,6 +47,112 @@ alias paste='pbpaste'
 """
 
 
+class ShCodeCache(object):
+
+    """
+    Compiled code of python scripts keyed by their paths and validated by their
+    mtime and size. The most recently used entries are kept in memory. They can
+    also be persisted to disk, similar to __pycache__.
+
+    :param int size: Maximum number of code objects kept in memory
+    :param str cache_dir: Directory to persist code objects in. No persistence if empty.
+    """
+
+    def __init__(self, size=32, cache_dir=None, debug=False):
+        self.size = size
+        self.cache_dir = cache_dir
+        self.debug = debug
+        self.logger = logging.getLogger('StaSh.CodeCache')
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0  # misses that are loaded from disk instead of compiled
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_code(self, filename):
+        """
+        Get the compiled code of the given script, compile it if necessary.
+
+        :param str filename: Absolute path of the script
+        :rtype: code
+        """
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size)
+
+        with self._lock:
+            entry = self._cache.pop(filename, None)
+            if entry is not None and entry[0] == stamp:
+                self._cache[filename] = entry  # move to the most recently used end
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        code = self._load(filename, stamp)
+        if code is None:
+            with open(filename, 'rU') as ins:
+                source = ins.read()
+            code = compile(source, filename, 'exec', dont_inherit=True)
+            self._dump(filename, stamp, code)
+        else:
+            self.disk_hits += 1
+
+        if self.size > 0:
+            with self._lock:
+                self._cache[filename] = (stamp, code)
+                while len(self._cache) > self.size:
+                    self._cache.popitem(last=False)
+
+        return code
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = self.disk_hits = 0
+
+    def _get_cache_file(self, filename):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.cache_dir,
+                            '%s.%s.pyc' % (name, hashlib.md5(filename).hexdigest()[:16]))
+
+    def _load(self, filename, stamp):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._get_cache_file(filename), 'rb') as ins:
+                magic, mtime, size, cached_filename, code = marshal.load(ins)
+        except Exception:  # missing, corrupted or stale file
+            return None
+        if magic == imp.get_magic() and (mtime, size) == stamp and cached_filename == filename:
+            return code
+
+    def _dump(self, filename, stamp, code):
+        if not self.cache_dir:
+            return
+        cache_file = self._get_cache_file(filename)
+        tmp_file = '%s.%s.tmp' % (cache_file, threading.currentThread().ident)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(tmp_file, 'wb') as outs:
+                marshal.dump((imp.get_magic(), stamp[0], stamp[1], filename, code), outs)
+            os.rename(tmp_file, cache_file)  # never leave a partially written file
+        except (IOError, OSError) as e:
+            if self.debug:
+                self.logger.debug('%s: cannot save compiled code: %s\n' % (filename, e))
+
+
+class ShPipeStages(list):
+    """
+    The workers running the commands of a pipe sequence but the last one. A worker
+    waiting for them to finish is blocked on them, and is woken up by killing them.
+    """
+
+    def wake_up(self):
+        for worker in self:
+            worker.kill()
+
+
 class ShRuntime(object):
 
     """
@@ -80,6 +195,31 @@ class ShRuntime(object):
             config.get('system', 'thread_type'),
             ShCtypesThread
         )
+        self.worker_pool = ShWorkerPool(config.getint('system', 'worker_pool_size'))
+        self.pipe_buffer_size = config.getint('system', 'pipe_buffer_size')
+        # Output of scripts to the screen is batched unless the mode is off
+        self.output_buffer_mode = config.get('system', 'output_buffer_mode')
+        if self.output_buffer_mode not in ShBufferedOutput.MODES:
+            self.output_buffer_mode = 'off'
+        # Python commands listed here run in pre-forked processes instead of threads
+        self.process_commands = set(config.get('system', 'process_commands').replace(',', ' ').split())
+        if self.process_commands and multiprocessing is not None and not IN_PYTHONISTA:
+            self.process_pool = ShProcessPool(config.getint('system', 'process_pool_size'))
+        else:
+            self.process_pool = None
+
+        py_code_cache_dir = config.get('system', 'py_code_cache_dir')
+        self.code_cache = ShCodeCache(
+            size=config.getint('system', 'py_code_cache_size'),
+            cache_dir=os.path.join(_STASH_ROOT, py_code_cache_dir) if py_code_cache_dir else None,
+            debug=debug)
+
+        # Command hash. Scripts in each command directory are indexed and the index
+        # is rebuilt only when the directory's mtime changes. Found commands are
+        # remembered with their hits, like Bash, until BIN_PATH changes.
+        self._dir_indices = {}
+        self.command_hash = {}
+        self._command_hash_bin_path = None
 
         # load history from last session
         # NOTE the first entry in history is the latest one
@@ -119,17 +259,30 @@ class ShRuntime(object):
                 else:
                     return fname
 
+        # Same as Bash, remembered commands are forgotten when the search path changes
+        bin_path = current_state.environ_get('BIN_PATH')
+        if bin_path != self._command_hash_bin_path:
+            self.command_hash = {}
+            self._command_hash_bin_path = bin_path
+
         # Match for commands in current dir and BIN_PATH
         # Effectively, current dir is always the first in BIN_PATH
-        for path in ['.'] + current_state.environ_get('BIN_PATH').split(':'):
+        for path in ['.'] + bin_path.split(':'):
             path = os.path.expanduser(path)
-            if os.path.exists(path):
-                for f in os.listdir(path):
-                    if f == filename or f == filename + '.py' or f == filename + '.sh':
-                        if os.path.isdir(f):
-                            dir_match_found = True
-                        else:
-                            return os.path.join(path, f)
+            dir_index = self.get_dir_index(path)
+            if dir_index and filename in dir_index[1]:
+                f, is_dir = dir_index[1][filename]
+                if is_dir:
+                    dir_match_found = True
+                else:
+                    script_file = os.path.join(path, f)
+                    entry = self.command_hash.get(filename)
+                    if entry and entry[0] == script_file:
+                        entry[1] += 1
+                    else:
+                        self.command_hash[filename] = [script_file, 1]
+                    return script_file
+
         if dir_match_found:
             raise ShIsDirectory('%s: is a directory' % filename)
         else:
@@ -141,17 +294,74 @@ class ShRuntime(object):
         all_names = []
         for path in ['.'] + current_state.environ_get('BIN_PATH').split(':'):
             path = os.path.expanduser(path)
-            if os.path.exists(path):
-                for f in os.listdir(path):
-                    if not os.path.isdir(f) and (f.endswith('.py') or f.endswith('.sh')):
-                        all_names.append(f.replace(' ', '\\ '))
+            dir_index = self.get_dir_index(path)
+            if dir_index:
+                all_names.extend(f.replace(' ', '\\ ') for f in dir_index[2])
         return all_names
 
+    def get_dir_index(self, path):
+        """
+        Get the index of scripts in the given directory. The index is cached and
+        only rebuilt when the directory's mtime changes.
+
+        :param str path: The directory
+        :return: The directory's mtime, a dict of command name to (file name, is_dir)
+                 and a list of file names of all scripts. None if the path is not
+                 a directory.
+        :rtype: (float, dict, [str]) | None
+        """
+        abspath = os.path.abspath(path)
+        try:
+            mtime = os.stat(abspath).st_mtime
+        except OSError:
+            self._dir_indices.pop(abspath, None)
+            return None
+
+        dir_index = self._dir_indices.get(abspath)
+        if dir_index is not None and dir_index[0] == mtime:
+            return dir_index
+
+        try:
+            fnames = os.listdir(abspath)
+        except OSError:  # not a directory
+            return None
+
+        # A command name matches a file of the same name first, then .py and .sh.
+        # Files are always preferred over directories.
+        ranked = {}
+        script_fnames = []
+        for f in fnames:
+            is_dir = os.path.isdir(os.path.join(abspath, f))
+            root, ext = os.path.splitext(f)
+            candidates = [(f, 0)]
+            if ext in ('.py', '.sh'):
+                candidates.append((root, 1 if ext == '.py' else 2))
+                if not is_dir:
+                    script_fnames.append(f)
+            for name, rank in candidates:
+                rank += 3 if is_dir else 0
+                if name not in ranked or rank < ranked[name][0]:
+                    ranked[name] = (rank, f, is_dir)
+
+        dir_index = (mtime,
+                     dict((name, (f, is_dir)) for name, (_, f, is_dir) in ranked.items()),
+                     script_fnames)
+        self._dir_indices[abspath] = dir_index
+        return dir_index
+
+    def reset_command_hash(self):
+        """
+        Forget all remembered commands and indexed directories.
+        """
+        self.command_hash = {}
+        self._dir_indices = {}
+
     def run(self, input_=None,
             final_ins=None, final_outs=None, final_errs=None,
             add_to_history=None,
             add_new_inp_line=None,
-            persistent=True):
+            persistent=True,
+            is_background=False):
         """
         This is the entry for running shell commands.
 
@@ -166,6 +376,9 @@ class ShRuntime(object):
                            all variables are by default persistent. It is set to False by
                            exec_sh_file so commands inside the shell script do not affect
                            its parent shell.
+        :param is_background: Whether or not the worker starts as a background job. The
+                              worker is put into background before it starts so it never
+                              runs as a foreground child of its parent.
         :return:
         :rtype: ShBaseThread
         """
@@ -174,6 +387,9 @@ class ShRuntime(object):
         if input_ is None:
             input_ = self.stash.io
 
+        # Output of the current worker must show up before its child's output
+        self.stash.io.flush_output()
+
         # noinspection PyDocstring
         def fn():
             current_worker, _ = self.get_current_worker_and_state()
@@ -219,12 +435,12 @@ class ShRuntime(object):
                                 pipe_sequence = expanded.next()
                                 if pipe_sequence.in_background:
                                     # For background command, separate worker is created
-                                    bg_worker = self.run(pipe_sequence,
-                                                         final_ins=final_ins,
-                                                         final_outs=final_outs,
-                                                         final_errs=final_errs,
-                                                         persistent=False)  # bg thread is not persistent
-                                    bg_worker.set_background()
+                                    self.run(pipe_sequence,
+                                             final_ins=final_ins,
+                                             final_outs=final_outs,
+                                             final_errs=final_errs,
+                                             persistent=False,  # bg thread is not persistent
+                                             is_background=True)
                                 else:
                                     self.run_pipe_sequence(pipe_sequence,
                                                            final_ins=final_ins,
@@ -294,14 +510,16 @@ class ShRuntime(object):
                         os.chdir(current_worker.state.enclosed_cwd)
 
         # Get the parent thread
-        parent_thread = threading.currentThread()
+        parent_thread, _ = self.get_current_worker_and_state()
 
         # UI thread is substituted by runtime
-        if not isinstance(parent_thread, ShBaseThread):
+        if parent_thread is None:
             parent_thread = self
 
         child_thread = self.ShThread(self.worker_registry, parent_thread, input_, target=fn)
-        child_thread.start()
+        if is_background:
+            child_thread.set_background()
+        self.worker_pool.start(child_thread)
 
         return child_thread
 
@@ -314,110 +532,230 @@ class ShRuntime(object):
 
     def run_pipe_sequence(self, pipe_sequence,
                           final_ins=None, final_outs=None, final_errs=None):
+        """
+        Run the commands of a pipe sequence at the same time, connected by pipes.
+
+        The return value is the same as when the commands ran one after another and
+        the pipe sequence stopped at the first failing one, i.e. it is that of the
+        first command that fails. The commands after it are not stopped though, as
+        they are already running. They get EOF once the failing command has ended.
+        """
         if self.debug:
             self.logger.debug(str(pipe_sequence))
 
         _, current_state = self.get_current_worker_and_state()
+        saved_return_value = current_state.return_value
 
         n_simple_commands = len(pipe_sequence.lst)
 
-        prev_outs = None
-        for idx, simple_command in enumerate(pipe_sequence.lst):
-
-            # The enclosing_environ needs to be reset for each simple command
-            # i.e. A=42 script1 | script2
-            # The value of A should not be carried to script2
-            current_state.enclosing_environ = {}
-            for assignment in simple_command.assignments:
-                current_state.enclosing_environ[assignment.identifier] = assignment.value
+        # All but the last command run in their own background workers, at the same
+        # time as the last command which runs in the current worker. Each command's
+        # output is connected to the next command's input with a pipe.
+        stage_workers = []
+        ins = final_ins or current_state.sys_stdin__
+        last_pipe = None
+        try:
+            for idx, simple_command in enumerate(pipe_sequence.lst):
 
-            # Only update the worker's env for pure assignments
-            if simple_command.cmd_word == '' and idx == 0 and n_simple_commands == 1:
-                current_state.environ.update(current_state.enclosing_environ)
+                # The enclosing_environ needs to be reset for each simple command
+                # i.e. A=42 script1 | script2
+                # The value of A should not be carried to script2
                 current_state.enclosing_environ = {}
+                for assignment in simple_command.assignments:
+                    current_state.enclosing_environ[assignment.identifier] = assignment.value
+
+                # Only update the worker's env for pure assignments
+                if simple_command.cmd_word == '' and idx == 0 and n_simple_commands == 1:
+                    current_state.environ.update(current_state.enclosing_environ)
+                    current_state.enclosing_environ = {}
+
+                outs = current_state.sys_stdout__
+                errs = current_state.sys_stderr__
+
+                if simple_command.io_redirect:
+                    # Truncate file or append to file
+                    mode = 'w' if simple_command.io_redirect.operator == '>' else 'a'
+                    # For simplicity, stdout redirect works for stderr as well.
+                    # Note this is different from a real shell.
+                    if simple_command.io_redirect.filename == '&3':
+                        outs = _SYS_STDOUT
+                        errs = _SYS_STDERR
+                    else:
+                        errs = outs = open(simple_command.io_redirect.filename, mode)
+                    # Output has gone to a file, the next command gets a dummy empty string as ins
+                    next_ins = StringIO()
+
+                elif idx < n_simple_commands - 1:  # before the last piped command
+                    outs = next_ins = last_pipe = ShPipe(self.pipe_buffer_size)
 
-            if prev_outs:
-                # If previous output has gone to a file, we use a dummy empty string as ins
-                ins = StringIO() if type(prev_outs) == file else prev_outs
-            else:
-                ins = final_ins or current_state.sys_stdin__
-
-            outs = current_state.sys_stdout__
-            errs = current_state.sys_stderr__
-
-            if simple_command.io_redirect:
-                # Truncate file or append to file
-                mode = 'w' if simple_command.io_redirect.operator == '>' else 'a'
-                # For simplicity, stdout redirect works for stderr as well.
-                # Note this is different from a real shell.
-                if simple_command.io_redirect.filename == '&3':
-                    outs = _SYS_STDOUT
-                    errs = _SYS_STDERR
                 else:
-                    errs = outs = open(simple_command.io_redirect.filename, mode)
+                    if final_outs:
+                        outs = final_outs
+                    if final_errs:
+                        errs = final_errs
 
-            elif idx < n_simple_commands - 1:  # before the last piped command
-                outs = StringIO()
+                if self.debug:
+                    self.logger.debug('io %s %s\n' % (ins, outs))
 
-            else:
-                if final_outs:
-                    outs = final_outs
-                if final_errs:
-                    errs = final_errs
+                if idx < n_simple_commands - 1:
+                    stage_workers.append(
+                        self.start_pipe_stage(simple_command, ins, outs, errs, close_ins=idx > 0))
+                    ins = next_ins
+                else:
+                    last_command_ran = self.exec_simple_command(simple_command, ins, outs, errs)
 
-            if self.debug:
-                self.logger.debug('io %s %s\n' % (ins, outs))
+        except KeyboardInterrupt:
+            for worker in stage_workers:
+                worker.kill()
+            raise
+
+        finally:
+            # Commands still writing to the pipe read by the last command get a broken pipe
+            if last_pipe is not None:
+                last_pipe.close_read()
+            self.join_pipe_stages(stage_workers)
+
+        # A command that is not run, e.g. not found, fails without a return value
+        outcomes = [(worker.command_ran, worker.state.return_value) for worker in stage_workers]
+        outcomes.append((last_command_ran, current_state.return_value))
+        return_value = saved_return_value
+        for command_ran, command_return_value in outcomes:
+            if not command_ran:
+                break
+            return_value = command_return_value
+            if return_value != 0:
+                break
+        current_state.return_value = return_value
+
+    def join_pipe_stages(self, stage_workers):
+        """
+        Wait for the workers of a pipe sequence's commands. They are killed if the
+        current worker is killed meanwhile, e.g. when a command still reads from the
+        terminal after the last command has finished, so they do not linger as jobs.
+
+        :param [ShBaseThread] stage_workers: The workers
+        """
+        current_worker, _ = self.get_current_worker_and_state()
+        stage_workers = ShPipeStages(stage_workers)
+        try:
+            if current_worker is not None:
+                # The worker must be reachable for wake up before its killed flag is checked
+                current_worker.blocked_on = stage_workers
+                if current_worker.killed:
+                    stage_workers.wake_up()
+            for worker in stage_workers:
+                worker.join()
+        except KeyboardInterrupt:
+            stage_workers.wake_up()
+            for worker in stage_workers:
+                worker.join()
+            raise
+        finally:
+            if current_worker is not None:
+                current_worker.blocked_on = None
 
+    def start_pipe_stage(self, simple_command, ins, outs, errs, close_ins=False):
+        """
+        Run a command of a pipe sequence in its own background worker so it runs at
+        the same time as other commands of the pipe sequence.
+
+        :param ShSimpleCommand simple_command: The command to run
+        :param ins: The input. If it is a ShPipe and close_ins is True, its read end is
+                    closed when the command finishes.
+        :param outs: The output. If it is a ShPipe, its write end is closed when the
+                     command finishes so the next command gets EOF.
+        :param errs: The error output
+        :param bool close_ins: Whether or not the input belongs to this command only
+        :return: The worker. Its command_ran tells whether the command was run
+        :rtype: ShBaseThread
+        """
+        def fn():
+            current_worker, _ = self.get_current_worker_and_state()
             try:
-                if simple_command.cmd_word != '':
-                    script_file = self.find_script_file(simple_command.cmd_word)
+                current_worker.command_ran = self.exec_simple_command(simple_command, ins, outs, errs)
+            except KeyboardInterrupt:
+                pass  # killed together with its pipe sequence
+            finally:
+                if isinstance(outs, ShPipe):
+                    outs.close_write()
+                if close_ins and isinstance(ins, ShPipe):
+                    ins.close_read()
+                current_worker.cleanup()
 
-                    if self.debug:
-                        self.logger.debug('script is %s\n' % script_file)
+        parent_thread, _ = self.get_current_worker_and_state()
+        if parent_thread is None:
+            parent_thread = self
 
-                    if self.input_encoding_utf8:
-                        # Python 2 is not fully unicode compatible. Some modules (e.g. runpy)
-                        # insist for ASCII arguments. The encoding here helps eliminates possible
-                        # errors caused by unicode arguments.
-                        simple_command_args = [arg.encode('utf-8') for arg in simple_command.args]
-                    else:
-                        simple_command_args = simple_command.args
+        stage_worker = self.ShThread(self.worker_registry, parent_thread, simple_command, target=fn)
+        stage_worker.command_ran = False
+        # Background workers do not take the parent's foreground child slot, which
+        # is needed by the last command of the pipe sequence.
+        stage_worker.set_background()
+        self.worker_pool.start(stage_worker)
 
-                    if script_file.endswith('.py'):
-                        self.exec_py_file(script_file, simple_command_args, ins, outs, errs)
+        return stage_worker
+
+    def exec_simple_command(self, simple_command, ins, outs, errs):
+        """
+        Run a single command with the given IO.
+
+        :param ShSimpleCommand simple_command: The command to run
+        :param ins: The input
+        :param outs: The output, closed afterwards if it is a file
+        :param errs: The error output
+        :return: False if the command cannot be run, e.g. it is not found
+        :rtype: bool
+        """
+        _, current_state = self.get_current_worker_and_state()
 
-                    elif is_binary_file(script_file):
-                        raise ShNotExecutable(script_file)
+        try:
+            if simple_command.cmd_word != '':
+                script_file = self.find_script_file(simple_command.cmd_word)
 
-                    else:
-                        self.exec_sh_file(script_file, simple_command_args, ins, outs, errs)
+                if self.debug:
+                    self.logger.debug('script is %s\n' % script_file)
 
+                if self.input_encoding_utf8:
+                    # Python 2 is not fully unicode compatible. Some modules (e.g. runpy)
+                    # insist for ASCII arguments. The encoding here helps eliminates possible
+                    # errors caused by unicode arguments.
+                    simple_command_args = [arg.encode('utf-8') for arg in simple_command.args]
                 else:
-                    current_state.return_value = 0
+                    simple_command_args = simple_command.args
+
+                if script_file.endswith('.py'):
+                    if self.process_pool is not None and self.process_pool.n_processes > 0 and \
+                            os.path.splitext(os.path.basename(script_file))[0] in self.process_commands:
+                        self.exec_py_file_in_process(script_file, simple_command_args, ins, outs, errs)
+                    else:
+                        self.exec_py_file(script_file, simple_command_args, ins, outs, errs)
 
-                if current_state.return_value != 0:
-                    break  # break out of the pipe_sequence, but NOT pipe_sequence list
+                elif is_binary_file(script_file):
+                    raise ShNotExecutable(script_file)
 
-                if isinstance(outs, StringIO):
-                    outs.seek(0)  # rewind for next command in the pipe sequence
+                else:
+                    self.exec_sh_file(script_file, simple_command_args, ins, outs, errs)
 
-                prev_outs = outs
+            else:
+                current_state.return_value = 0
 
-            # This catch all exception is for when the exception is raised
-            # outside of the actual command execution, i.e. exec_py_file
-            # exec_sh_file, e.g. command not found, not executable etc.
-            except Exception as e:
-                err_msg = '%s\n' % e.message
-                if self.debug:
-                    self.logger.debug(err_msg)
-                self.stash.write_message(err_msg)
-                break  # break out of the pipe_sequence, but NOT pipe_sequence list
+            return True
 
-            finally:
-                if type(outs) is file:
-                    outs.close()
-                if isinstance(ins, StringIO):  # release the string buffer
-                    ins.close()
+        # This catch all exception is for when the exception is raised
+        # outside of the actual command execution, i.e. exec_py_file
+        # exec_sh_file, e.g. command not found, not executable etc.
+        except Exception as e:
+            err_msg = '%s\n' % e.message
+            if self.debug:
+                self.logger.debug(err_msg)
+            self.stash.write_message(err_msg)
+            return False
+
+        finally:
+            if type(outs) is file:
+                outs.close()
+            if isinstance(ins, StringIO):  # release the string buffer
+                ins.close()
 
     def exec_py_file(self, filename,
                      args=None,
@@ -434,28 +772,48 @@ class ShRuntime(object):
         if errs:
             current_state.sys_stderr = errs
 
+        # Writes to the screen are batched. Both stdout and stderr share the same
+        # buffer so they stay in order.
+        output_buffer = None
+        if self.output_buffer_mode != 'off':
+            if self.stash.io in (current_state.sys_stdout, current_state.sys_stderr):
+                output_buffer = ShBufferedOutput.from_mode(self.stash.io, self.output_buffer_mode)
+                if current_state.sys_stdout is self.stash.io:
+                    current_state.sys_stdout = output_buffer
+                if current_state.sys_stderr is self.stash.io:
+                    current_state.sys_stderr = output_buffer
+
         file_path = os.path.relpath(filename)
         namespace = dict(locals(), **globals())
         namespace['__name__'] = '__main__'
         namespace['__file__'] = os.path.abspath(file_path)
         namespace['_stash'] = self.stash
 
-        # First argument is the script name
-        sys.argv = [os.path.basename(filename)] + (args or [])
-
-        # Set current os environ to the threading environ
-        saved_os_environ = os.environ
-        os.environ = dict(current_state.environ)
+        # First argument is the script name. sys.argv is dispatched to the worker's own.
+        current_state.sys_argv = [os.path.basename(filename)] + (args or [])
+        # A script that assigns to sys.argv replaces the dispatching wrapper
+        saved_sys_argv = sys.argv
+
+        # The script has its own os.environ and sys.path, which are dispatched to
+        # by the wrappers while scripts are running. Python scripts may run at the
+        # same time, e.g. commands in a pipe sequence or background jobs.
+        saved_script_environ = current_state.script_environ
+        saved_script_sys_path = current_state.script_sys_path
+        current_state.script_environ = current_state.environ.to_dict()
         # Honor any leading vars, e.g. A=42 echo $A
-        os.environ.update(current_state.enclosing_environ)
+        current_state.script_environ.update(current_state.enclosing_environ)
+        current_state.script_sys_path = current_state.sys_path[:]
 
-        # This needs to be done after environ due to possible leading PYTHONPATH var
-        saved_sys_path = sys.path
-        sys.path = current_state.sys_path[:]
-        self.handle_PYTHONPATH()  # Make sure PYTHONPATH is honored
+        # The print statement of another script may have left a pending soft space
+        sys.stdout.softspace = sys.stderr.softspace = 0
 
+        begin_script()
         try:
-            execfile(file_path, namespace, namespace)
+            # This needs to be done after environ due to possible leading PYTHONPATH var
+            self.handle_PYTHONPATH()  # Make sure PYTHONPATH is honored
+
+            # Same as execfile except the compiled code is cached
+            exec self.code_cache.get_code(os.path.abspath(file_path)) in namespace, namespace
             current_state.return_value = 0
 
         except SystemExit as e:
@@ -464,6 +822,10 @@ class ShRuntime(object):
         except Exception as e:
             current_state.return_value = 1
 
+            # The next command in the pipe sequence has stopped reading, e.g. head
+            if isinstance(e, IOError) and e.errno == errno.EPIPE:
+                return
+
             etype, evalue, tb = sys.exc_info()
             err_msg = '%s: %s\n' % (repr(etype), evalue)
             if self.debug:
@@ -480,8 +842,73 @@ class ShRuntime(object):
             # Thread specific vars are not modified, e.g. current_state.environ is unchanged.
             # This means the vars cannot be changed inside a python script. It can only be
             # done through shell command, e.g. NEW_VAR=42
-            sys.path = saved_sys_path
-            os.environ = saved_os_environ
+            if output_buffer is not None:
+                output_buffer.close()
+                if current_state.sys_stdout is output_buffer:
+                    current_state.sys_stdout = self.stash.io
+                if current_state.sys_stderr is output_buffer:
+                    current_state.sys_stderr = self.stash.io
+
+            current_state.script_environ = saved_script_environ
+            current_state.script_sys_path = saved_script_sys_path
+            end_script()
+            if sys.argv is not saved_sys_argv:
+                sys.argv = saved_sys_argv
+
+    def exec_py_file_in_process(self, filename,
+                                args=None,
+                                ins=None, outs=None, errs=None):
+        """
+        Run a python script in a process of the process pool. It does not share the
+        interpreter with other commands, which suits CPU bound scripts, but it
+        cannot use _stash.
+        """
+        _, current_state = self.get_current_worker_and_state()
+
+        ins = ins or current_state.sys_stdin
+        outs = outs or current_state.sys_stdout
+        errs = errs or current_state.sys_stderr
+
+        # The environ and sys.path are worked out the same way as for exec_py_file
+        saved_script_environ = current_state.script_environ
+        saved_script_sys_path = current_state.script_sys_path
+        current_state.script_environ = current_state.environ.to_dict()
+        current_state.script_environ.update(current_state.enclosing_environ)
+        current_state.script_sys_path = current_state.sys_path[:]
+        begin_script()
+        try:
+            self.handle_PYTHONPATH()
+            environ = dict((k, str(v)) for k, v in current_state.script_environ.items())
+            sys_path = list(current_state.script_sys_path)
+        finally:
+            current_state.script_environ = saved_script_environ
+            current_state.script_sys_path = saved_script_sys_path
+            end_script()
+
+        file_path = os.path.abspath(filename)
+        try:
+            return_value, err_msg = self.process_pool.run_script(
+                self.code_cache.get_code(file_path),
+                file_path,
+                [os.path.basename(filename)] + (args or []),
+                environ,
+                os.getcwd(),
+                sys_path,
+                ins, outs, errs,
+                py_traceback=self.py_traceback)
+
+        except IOError as e:
+            # The next command in the pipe sequence has stopped reading, e.g. head
+            if e.errno == errno.EPIPE:
+                current_state.return_value = 1
+                return
+            raise
+
+        current_state.return_value = return_value
+        if err_msg:
+            if self.debug:
+                self.logger.debug(err_msg)
+            self.stash.write_message(err_msg)
 
     def exec_sh_file(self, filename,
                      args=None,
@@ -641,8 +1068,8 @@ class ShRuntime(object):
         :return:
         :rtype: (ShBaseThread, ShState)
         """
-        current_worker = threading.currentThread()
-        if isinstance(current_worker, ShBaseThread):
+        current_worker = getattr(_WORKER_LOCAL, 'worker', None)
+        if current_worker is not None:
             return current_worker, current_worker.state
         else:  # UI thread uses runtime for its state
             return None, self.state
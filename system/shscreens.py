@@ -1,8 +1,9 @@
 # coding: utf-8
 import logging
-from time import time
+from time import time, sleep
 
 import threading
+import weakref
 from collections import deque, namedtuple
 from contextlib import contextmanager
 
@@ -73,6 +74,7 @@ class ShChar(_Char):
 
 DEFAULT_CHAR = ShChar(data=' ', fg='default', bg='default')
 
+
 # noinspection PyAttributeOutsideInit
 class ShSequentialScreen(object):
 
@@ -80,17 +82,36 @@ class ShSequentialScreen(object):
     The sequential type in-memory screen. Running scripts can only
     add characters at the end of the screen buffer, no backspace or
     cursor movement is possible. Hence it is sequential.
+
+    The buffer is stored as lines of plain text plus a list of styled runs.
+    Each run is a tuple of (start, length, style_id) and covers a range of the
+    text with the same style. Styles are interned in a table shared by all runs.
+    The start of a run counts from the first char ever drawn since the last
+    reset, so the runs need no update when the top lines are removed.
+
+    Lines removed from the top are kept in the scrollback as records of
+    (offset, line), where the offset counts the same way as the start of a run.
     :param int nlines_max: The maximum number of lines to be stored.
+    :param int scrollback_max: The maximum number of lines kept in the scrollback.
     """
 
-    def __init__(self, stash, nlines_max=100, debug=False):
+    def __init__(self, stash, nlines_max=100, scrollback_max=10000, debug=False):
 
         self.stash = stash
         self.nlines_max = nlines_max
         self.debug = debug
         self.logger = logging.getLogger('StaSh.Screen')
 
-        self._buffer = deque()  # buffer to hold chars
+        # Lines of the buffer. Every line but the last one ends with a LF, so
+        # the buffer always has at least one (possibly empty) line.
+        self._lines = deque([u''])
+        self._length = 0  # number of chars in the buffer
+        self._runs = deque()  # styled runs of the text
+        self.scrollback = deque(maxlen=scrollback_max)
+        self._offset = 0  # number of chars removed from the top since reset
+        # The style table, the default style always has the id of 0
+        self._styles = [DEFAULT_CHAR]
+        self._style_ids = {DEFAULT_CHAR: 0}
         self.lock = threading.Lock()
 
         self.attrs = ShChar(' ')
@@ -104,7 +125,12 @@ class ShSequentialScreen(object):
         with at least one parameter (even it is a dummy 0).
         """
         # empty the buffer
-        self._buffer.clear()
+        self._lines.clear()
+        self._lines.append(u'')
+        self._length = 0
+        self._runs.clear()
+        self._offset = 0
+        self.scrollback.clear()
 
         # The cursor position
         self.cursor_x = 0
@@ -120,24 +146,97 @@ class ShSequentialScreen(object):
         # relative to start of the Screen's buffer.
         self.intact_right_bound = 0
 
-        self.nlines = 0
-
     @property
     def text(self):
         """
         :rtype: str
         """
-        return ''.join(char.data for char in self._buffer)
+        return u''.join(self._lines)
+
+    @property
+    def scrollback_text(self):
+        """
+        The lines removed from the top of the screen, from old to new.
+        :rtype: str
+        """
+        return u''.join(line for _, line in self.scrollback)
+
+    @property
+    def text_length(self):
+        """
+        :rtype: int
+        """
+        return self._length
+
+    @property
+    def nlines(self):
+        """
+        Number of LFs in the buffer.
+        :rtype: int
+        """
+        return len(self._lines) - 1
+
+    @property
+    def x_last_lf_end(self):
+        """
+        The location right after the last LF.
+        :rtype: int
+        """
+        return self._length - len(self._lines[-1])
+
+    def _locate(self, x):
+        """
+        Find the line where the given location is. The search starts from the
+        last line as the location is normally near the end.
+        :param int x: Location relative to the beginning of the screen buffer.
+        :return: Index of the line and the location of its first char.
+        :rtype: (int, int)
+        """
+        lines = self._lines
+        idx = len(lines) - 1
+        line_start = self._length - len(lines[idx])
+        while line_start > x and idx > 0:
+            idx -= 1
+            line_start -= len(lines[idx])
+        return idx, line_start
+
+    def _text_from(self, x):
+        """
+        :param int x: Location relative to the beginning of the screen buffer.
+        :return: The trailing text from the given location.
+        :rtype: str
+        """
+        lines = self._lines
+        idx, line_start = self._locate(x)
+        return u''.join([lines[i] for i in xrange(idx, len(lines))])[x - line_start:]
 
     @property
     def renderable_chars(self):
         """
-        Note this return a list of ShChar not string.
         Trailing characters that need to be re-rendered.
-        :rtype: [ShChar]
+        :rtype: str
+        """
+        _, rbound = self.get_bounds()
+        return self._text_from(rbound)
+
+    @property
+    def renderable_runs(self):
+        """
+        Styled runs of the renderable_chars. Each run is a tuple of start, length
+        and the style (a ShChar) with start relative to the renderable_chars.
+        :rtype: [(int, int, ShChar)]
         """
         _, rbound = self.get_bounds()
-        return [self._buffer[x] for x in range(rbound, len(self._buffer))]
+        rbound += self._offset
+        ret = []
+        for start, length, style_id in reversed(self._runs):
+            end = start + length
+            if end <= rbound:
+                break
+            start = max(start, rbound)
+            ret.append((start - rbound, end - start, self._styles[style_id]))
+        ret.reverse()
+        return ret
 
     @property
     def x_modifiable(self):
@@ -148,19 +247,14 @@ class ShSequentialScreen(object):
         """
         # The position is either the x_drawend or last LF location plus one,
         # whichever is larger.
-        for idx in reversed(range(self.x_drawend, len(self._buffer))):
-            if self._buffer[idx].data == '\n':
-                return idx + 1
-        else:
-            return self.x_drawend
+        return max(self.x_last_lf_end, self.x_drawend)
 
     @property
     def modifiable_chars(self):
         """
         :rtype: str
         """
-        return ''.join(self._buffer[idx].data
-                       for idx in range(self.x_modifiable, len(self._buffer)))
+        return self._text_from(self.x_modifiable)
 
     @modifiable_chars.setter
     def modifiable_chars(self, s):
@@ -168,7 +262,7 @@ class ShSequentialScreen(object):
         Set the modifiable_chars to the given string.
         :param str s: A new value for modifiable_chars.
         """
-        self.replace_in_range((self.x_modifiable, len(self._buffer)), s)
+        self.replace_in_range((self.x_modifiable, self._length), s)
 
     @contextmanager
     def acquire_lock(self):
@@ -200,26 +294,114 @@ class ShSequentialScreen(object):
         Mark everything is rendered.
         """
         self.intact_left_bound = 0
-        self.intact_right_bound = len(self._buffer)
+        self.intact_right_bound = self._length
+
+    def _get_style_id(self, style):
+        """
+        Intern the given style in the style table.
+        :param ShChar style: The style
+        :rtype: int
+        """
+        style_id = self._style_ids.get(style)
+        if style_id is None:
+            style_id = self._style_ids[style] = len(self._styles)
+            self._styles.append(style)
+        return style_id
+
+    def _add_run(self, start, length, style_id):
+        """
+        Add a run to the end of the runs. It is merged into the last run if
+        they are adjacent and of the same style.
+        """
+        if length == 0:
+            return
+        runs = self._runs
+        if runs:
+            last_start, last_length, last_style_id = runs[-1]
+            if last_style_id == style_id and last_start + last_length == start:
+                runs[-1] = (last_start, last_length + length, style_id)
+                return
+        runs.append((start, length, style_id))
+
+    def _replace(self, rng, s, style_id=0):
+        """
+        Replace the text in the given range and update the runs accordingly.
+        Only the runs after the start of the range are touched.
+        :param (int, int) rng: Range of buffer to be replaced
+        :param str s: String to be inserted.
+        :param int style_id: Style of the inserted string.
+        """
+        xs, xe = rng[0] + self._offset, rng[1] + self._offset
+        delta = len(s) - (xe - xs)
+        runs = self._runs
+        trailing_runs = []
+        while runs and runs[-1][0] + runs[-1][1] > xs:
+            trailing_runs.append(runs.pop())
+        trailing_runs.reverse()
+        for start, length, sid in trailing_runs:  # chars before the range
+            if start < xs:
+                self._add_run(start, xs - start, sid)
+        self._add_run(xs, len(s), style_id)
+        for start, length, sid in trailing_runs:  # chars after the range
+            end = start + length
+            if end > xe:
+                start = max(start, xe)
+                self._add_run(start + delta, end - start, sid)
+
+        lines = self._lines
+        idx, line_start = self._locate(rng[0])
+        if idx == len(lines) - 1 and '\n' not in s:
+            # Edits of the input line only touch the last line
+            line = lines[idx]
+            lines[idx] = line[:rng[0] - line_start] + s + line[rng[1] - line_start:]
+            self._length += delta
+            return
+        # Lines from the one where the range starts are split again
+        trailing_text = u''.join([lines.pop() for _ in xrange(idx, len(lines))][::-1])
+        self._append_text(trailing_text[:rng[0] - line_start] + s + trailing_text[rng[1] - line_start:])
+        self._length += delta
+
+    def _append_text(self, s):
+        """
+        Append the text to the end of the lines. The last line may be a complete
+        one, i.e. end with a LF, when the lines after it have just been removed.
+        """
+        lines = self._lines
+        if not lines or lines[-1].endswith('\n'):
+            lines.append(u'')
+        if '\n' in s:
+            new_lines = s.split('\n')
+            lines[-1] += new_lines[0] + '\n'
+            lines.extend([line + '\n' for line in new_lines[1:-1]])
+            lines.append(new_lines[-1])
+        else:
+            lines[-1] += s
 
-    # noinspection PyProtectedMember
     def draw(self, c):
         """
         Add given char to the right end of the buffer and update the last draw
         location. This method should ONLY be called by ShStream.
         :param str c: A new character to draw
         """
-        if len(self._buffer) < self.intact_right_bound:
-            self.intact_right_bound = len(self._buffer)
+        self.draw_text(c)
 
-        self._buffer.append(self.attrs._replace(data=c))
-        self.cursor_x = self.x_drawend = len(self._buffer)
+    def draw_text(self, s):
+        """
+        Add given string to the right end of the buffer and update the last
+        draw location. This method should ONLY be called by ShStream.
+        :param str s: A string of characters to draw
+        """
+        length = self._length
+        if length < self.intact_right_bound:
+            self.intact_right_bound = length
 
-        if c == '\n':
-            self.nlines += 1
-            self._ensure_nlines_max()
+        self._add_run(self._offset + length, len(s), self._get_style_id(self.attrs))
+        self._append_text(s)
+        self._length += len(s)
+        self.cursor_x = self.x_drawend = self._length
+
+        self._ensure_nlines_max()
 
-    # noinspection PyProtectedMember
     def replace_in_range(self, rng, s, relative_to_x_modifiable=False, set_drawend=False):
         """
         Replace the buffer content in the given range. This method should
@@ -232,7 +414,7 @@ class ShSequentialScreen(object):
         :return:
         """
         if rng is None:
-            rng = (len(self._buffer), len(self._buffer))
+            rng = (self._length, self._length)
 
         elif relative_to_x_modifiable:  # Convert to absolute location if necessary
             rng = rng[0] + self.x_modifiable, rng[1] + self.x_modifiable
@@ -241,16 +423,8 @@ class ShSequentialScreen(object):
         if rng[0] < self.intact_right_bound:
             self.intact_right_bound = rng[0]
 
-        rotate_n = max(len(self._buffer) - rng[1], 0)
-        try:
-            self._buffer.rotate(rotate_n)  # rotate buffer first so deletion is possible
-            if rng[0] != rng[1]:  # delete chars if necessary
-                self._pop_chars(rng[1] - rng[0])
-            # The newly inserted chars are always of default properties
-            self._buffer.extend(DEFAULT_CHAR._replace(data=c) for c in s)
-
-        finally:
-            self._buffer.rotate(-rotate_n)
+        # The newly inserted chars are always of default properties
+        self._replace((rng[0], max(rng[0], min(rng[1], self._length))), s)
 
         # Update cursor to the end of this replacement
         self.cursor_x = rng[0] + len(s)
@@ -259,14 +433,11 @@ class ShSequentialScreen(object):
         if set_drawend:
             self.x_drawend = self.cursor_x
 
-        nlf = s.count('\n')
-        if nlf > 0:
-            self.nlines += nlf
-            self._ensure_nlines_max()
+        self._ensure_nlines_max()
 
     def ensure_cursor_in_modifiable_range(self):
-        if self.cursor_x > len(self._buffer):
-            self.cursor_x = len(self._buffer)
+        if self.cursor_x > self._length:
+            self.cursor_x = self._length
         elif self.cursor_x < self.x_modifiable:
             self.cursor_x = self.x_modifiable
 
@@ -276,29 +447,38 @@ class ShSequentialScreen(object):
         :param n:
         :return:
         """
-        for _ in range(n):
-            self._buffer.pop()
-            if len(self._buffer) < self.intact_right_bound:
-                self.intact_right_bound = len(self._buffer)
+        length = self._length
+        n = min(n, length)
+        self._replace((length - n, length), '')
+        if length - n < self.intact_right_bound:
+            self.intact_right_bound = length - n
 
     def _ensure_nlines_max(self):
         """
         Keep number of lines under control
         """
-        char_count = line_count = 0
-        for _ in range(self.nlines_max, self.nlines):
-            # Remove the top line
-            for idx in range(len(self._buffer)):
-                char_count += 1
-                if self._buffer.popleft().data == '\n':
-                    line_count += 1
-                    break
+        if self.nlines <= self.nlines_max:
+            return
+        # Move the top lines to the scrollback
+        char_count = 0
+        for _ in xrange(self.nlines - self.nlines_max):
+            line = self._lines.popleft()
+            self.scrollback.append((self._offset + char_count, line))
+            char_count += len(line)
+
+        self._length -= char_count
+        self._offset += char_count
+        runs = self._runs
+        while runs and runs[0][0] + runs[0][1] <= self._offset:
+            runs.popleft()
+        if runs and runs[0][0] < self._offset:
+            start, length, style_id = runs[0]
+            runs[0] = (self._offset, start + length - self._offset, style_id)
 
         self.intact_left_bound += char_count
         self.intact_right_bound -= char_count
         self.cursor_x -= char_count
         self.x_drawend -= char_count
-        self.nlines -= line_count
 
     # noinspection PyProtectedMember
     def select_graphic_rendition(self, *attrs):
@@ -322,10 +502,23 @@ class ShSequentialScreen(object):
         self.attrs = self.attrs._replace(**replace)
 
 
-def sh_delay(func, nseconds):
-    t = threading.Timer(nseconds, func)
-    t.start()
-    return t
+def _run_render_scheduler(renderer_ref, dirty):
+    """
+    The body of the render scheduler thread. It holds the renderer only while
+    rendering a frame and stops when the renderer is gone.
+    :param weakref.ref renderer_ref: Weak reference to the ShSequentialRenderer
+    :param threading.Event dirty: Set when the screen needs to be rendered
+    """
+    while True:
+        dirty.wait()
+        renderer = renderer_ref()
+        if renderer is None:
+            break
+        try:
+            renderer._render_frame()
+        except Exception as e:
+            renderer.logger.error('render failed: %s' % repr(e))
+        del renderer
 
 
 class ShSequentialRenderer(object):
@@ -367,6 +560,9 @@ class ShSequentialRenderer(object):
         'default': BlackColor,
     }
 
+    # The minimum interval between frames is used when output comes in slowly.
+    # It doubles up to the maximum while output keeps coming in faster.
+    MIN_RENDER_INTERVAL = 1.0 / 60
     RENDER_INTERVAL = 0.1
 
     def __init__(self, screen, terminal, debug=False):
@@ -375,8 +571,21 @@ class ShSequentialRenderer(object):
         self.debug = debug
         self.logger = logging.getLogger('StaSh.SequentialRenderer')
         self.last_rendered_time = 0
+        self.render_interval = self.MIN_RENDER_INTERVAL
+
+        # Delayed rendering is done by a single scheduler thread that is woken
+        # up by the dirty flag.
+        self._dirty = threading.Event()
         self.render_thread = None
 
+        # NSDictionary of text attributes for each style, created once for
+        # each distinct style.
+        self._attributes_cache = {}
+
+        # Statistics
+        self.frames_rendered = 0
+        self.frames_coalesced = 0  # render requests merged into a pending frame
+
     @staticmethod
     def _same_style(char1, char2):
         return char1.fg == char2.fg \
@@ -405,40 +614,41 @@ class ShSequentialRenderer(object):
             'NSStrikethrough': 1 if attrs.strikethrough else 0,
         }
 
-    def _build_attributed_string(self, chars):
+    def _get_attributes(self, style):
+        """
+        Get the cached text attributes of the given style. Styles that look the
+        same as the default style share its attributes.
+        :param ShChar style: The style
+        """
+        try:
+            return self._attributes_cache[style]
+        except KeyError:
+            if style is not DEFAULT_CHAR and self._same_style(style, DEFAULT_CHAR):
+                attributes = self._get_attributes(DEFAULT_CHAR)
+            else:
+                attributes = ns(self._build_attributes(style))
+            self._attributes_cache[style] = attributes
+            return attributes
+
+    def _build_attributed_string(self, chars, runs):
         """
         Build attributed text in a more efficient way than char by char.
-        It groups characters with the same attributes and apply the attributes
-        to them at once.
-        :param [ShChar] chars: A list of ShChar upon which the attributed text is built.
+        The attributes are applied to each styled run at once.
+        :param str chars: The text upon which the attributed text is built.
+        :param [(int, int, ShChar)] runs: Styled runs of the text.
         :rtype: object
         """
         # Initialize a string with default attributes
+        default_attributes = self._get_attributes(DEFAULT_CHAR)
         attributed_text = NSMutableAttributedString.alloc().initWithString_attributes_(
-            ''.join(char.data for char in chars),
-            self._build_attributes(DEFAULT_CHAR),
+            chars,
+            default_attributes,
         ).autorelease()
 
-        prev_char = chars[0]
-        location = length = 0
-        for idx, curr_char in enumerate(chars):
-            length += 1
-            if not self._same_style(prev_char, curr_char):  # a group is found
-                if not self._same_style(prev_char, DEFAULT_CHAR):  # skip default attrs
-                    attributed_text.setAttributes_range_(
-                        self._build_attributes(prev_char),
-                        (location, length - 1)
-                    )
-                length = 1
-                location = idx
-                prev_char = curr_char
-
-            if idx == len(chars) - 1:  # last char
-                if not self._same_style(prev_char, DEFAULT_CHAR):
-                    attributed_text.setAttributes_range_(
-                        self._build_attributes(prev_char),
-                        (location, length)
-                    )
+        for location, length, style in runs:
+            attributes = self._get_attributes(style)
+            if attributes is not default_attributes:  # skip default attrs
+                attributed_text.setAttributes_range_(attributes, (location, length))
 
         return attributed_text
 
@@ -448,29 +658,62 @@ class ShSequentialRenderer(object):
         is delayed to throttle the total attempts of rendering.
         :param bool no_wait: Immediately render the screen without delay.
         """
-        # The last_rendered_time is useful to ensure that the first rendering
-        # is not delayed.
-        if time() - self.last_rendered_time > self.RENDER_INTERVAL or no_wait:
-            if self.render_thread is not None:
-                self.render_thread.cancel()
+        if no_wait:
             self._render()
-        else:  # delayed rendering
-            if self.render_thread is None or not self.render_thread.isAlive():
-                self.render_thread = sh_delay(self._render, self.RENDER_INTERVAL)
-            # Do nothing if there is already a delayed rendering thread waiting
+            return
+
+        if self._dirty.is_set():  # a frame is already pending
+            self.frames_coalesced += 1
+        else:
+            self._dirty.set()
+        if self.render_thread is None:
+            self._start_render_thread()
+
+    def _start_render_thread(self):
+        dirty = self._dirty
+        # Wake up the thread to stop when the renderer is garbage collected
+        renderer_ref = weakref.ref(self, lambda ref: dirty.set())
+        self.render_thread = threading.Thread(name='_shrenderer',
+                                              target=_run_render_scheduler,
+                                              args=(renderer_ref, dirty))
+        self.render_thread.daemon = True
+        self.render_thread.start()
+
+    def _render_frame(self):
+        """
+        Render a frame for the pending requests. The first frame after idle is
+        rendered immediately. Otherwise it waits for the render interval to pass
+        so that more output is coalesced into the frame.
+        """
+        delay = self.last_rendered_time + self.render_interval - time()
+        if delay > 0:
+            frames_coalesced = self.frames_coalesced
+            sleep(delay)
+            # Render less often if output is still coming in
+            if self.frames_coalesced > frames_coalesced:
+                self.render_interval = min(self.render_interval * 2, self.RENDER_INTERVAL)
+            else:
+                self.render_interval = self.MIN_RENDER_INTERVAL
+        else:
+            self.render_interval = self.MIN_RENDER_INTERVAL
+        # Requests during the rendering make another frame
+        self._dirty.clear()
+        self._render()
 
     @on_main_thread
     def _render(self):
         # This must run on the main UI thread. Otherwise it crashes.
 
         self.last_rendered_time = time()
+        self.frames_rendered += 1
 
         # Lock screen to get atomic information
         with self.screen.acquire_lock():
             intact_left_bound, intact_right_bound = self.screen.get_bounds()
-            screen_buffer_length = len(self.screen._buffer)
+            screen_buffer_length = self.screen.text_length
             cursor_x = self.screen.cursor_x
             renderable_chars = self.screen.renderable_chars
+            renderable_runs = self.screen.renderable_runs
             self.screen.clean()
 
         if IN_PYTHONISTA:
@@ -500,7 +743,7 @@ class ShSequentialRenderer(object):
                     tvo_texts.replaceCharactersInRange_withAttributedString_(
                         (intact_right_bound,
                          tv_text_length - intact_right_bound),
-                        self._build_attributed_string(renderable_chars)
+                        self._build_attributed_string(renderable_chars, renderable_runs)
                     )
                 else:  # empty string, pure deletion
                     tvo_texts.replaceCharactersInRange_withString_(
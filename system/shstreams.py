@@ -292,6 +292,9 @@ class ShStream(object):
     STATE_ESCAPE = 1
     STATE_ARGUMENTS = 2
 
+    #: Characters that are not drawn as is in the ``"stream"`` state
+    _pattern_special_char = re.compile(u'[%s%s%s%s]' % (ctrl.NUL, ctrl.DEL, ctrl.ESC, ctrl.CSI))
+
     def __init__(self, stash, main_screen, debug=False):
 
         self.consume_handlers = (self._stream, self._escape, self._arguments)
@@ -303,6 +306,7 @@ class ShStream(object):
 
         self.dispatch_handler = {
             'draw': self.main_screen.draw,
+            'draw_text': self.main_screen.draw_text,
             'reset': self.main_screen.reset,
             'select_graphic_rendition': self.main_screen.select_graphic_rendition,
         }
@@ -336,8 +340,19 @@ class ShStream(object):
             chars = chars.decode('utf-8', errors='ignore')
 
         with self.main_screen.acquire_lock():
-            for char in chars:
-                self.consume(char)
+            idx = 0
+            while idx < len(chars):
+                # Runs of plain text are drawn at once and only the special
+                # characters go through the state machine.
+                if self.state == self.STATE_STREAM:
+                    m = self._pattern_special_char.search(chars, idx)
+                    end = m.start() if m else len(chars)
+                    if end > idx:
+                        self.dispatch('draw_text', chars[idx:end], reset=False)
+                        idx = end
+                        continue
+                self.consume(chars[idx])
+                idx += 1
 
         if render_it:
             self.stash.renderer.render(no_wait=no_wait)
@@ -7,7 +7,8 @@ import sys
 import threading
 import weakref
 import ctypes
-from collections import OrderedDict
+import traceback
+from collections import OrderedDict, MutableMapping
 
 from .shcommon import M_64
 
@@ -21,6 +22,120 @@ environ: {}
 """
 
 
+#: The slots holding the worker that runs in the current thread and its state.
+#: They are set while a pool thread runs the worker.
+_WORKER_LOCAL = threading.local()
+
+
+#: Marks a key that is deleted in the top layer of a ShLayeredDict
+_DELETED = object()
+
+
+class ShLayeredDict(MutableMapping):
+    """
+    A dict that is copied without copying its items, used for the environ and
+    aliases of a worker state. The dict is a stack of layers. Only the top layer
+    is written to and the layers below are read only, so that they can be shared
+    between copies. A copy freezes the top layer and puts a new one on top of it
+    for both the original and the copy. Writes and copies are serialized so that
+    no write goes to a layer that is being frozen.
+
+    :param dict data: Initial items
+    """
+
+    #: A copy of a dict this deep flattens the layers into one
+    max_depth = 8
+
+    def __init__(self, data=None):
+        self._layers = [dict(data) if data else {}]
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                value = layer[key]
+                if value is _DELETED:
+                    break
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        for layer in self._layers:
+            if key in layer:
+                value = layer[key]
+                return default if value is _DELETED else value
+        return default
+
+    def __contains__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                return layer[key] is not _DELETED
+        return False
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._layers[0][key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            if len(self._layers) == 1:
+                del self._layers[0][key]
+            elif key in self:
+                self._layers[0][key] = _DELETED
+            else:
+                raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._flatten())
+
+    def __len__(self):
+        return len(self._flatten())
+
+    def __repr__(self):
+        return repr(self._flatten())
+
+    def keys(self):
+        return self._flatten().keys()
+
+    def to_dict(self):
+        """
+        Faster than dict(self), which looks up the keys one by one.
+        :rtype: dict
+        """
+        ret = self._flatten()
+        return dict(ret) if ret is self._layers[0] else ret
+
+    def _flatten(self):
+        """
+        :return: All items in a single new dict, unless there is only one layer
+        :rtype: dict
+        """
+        if len(self._layers) == 1:
+            return self._layers[0]
+        ret = {}
+        for layer in reversed(self._layers):
+            ret.update(layer)
+        for key in [key for key, value in ret.iteritems() if value is _DELETED]:
+            del ret[key]
+        return ret
+
+    def copy(self):
+        """
+        :rtype: ShLayeredDict
+        """
+        with self._lock:
+            layers = self._layers
+            if layers[0]:
+                if len(layers) >= self.max_depth:
+                    layers = [self._flatten()]
+                self._layers = [{}] + layers
+            else:
+                layers = layers[1:]
+        ret = ShLayeredDict()
+        ret._layers = [{}] + layers
+        return ret
+
+
 class ShState(object):
     """ State of the current worker thread
     """
@@ -31,16 +146,22 @@ class ShState(object):
                  sys_stdin=None,
                  sys_stdout=None,
                  sys_stderr=None,
-                 sys_path=None):
+                 sys_path=None,
+                 sys_argv=None):
 
-        self.aliases = aliases or {}
-        self.environ = environ or {}
+        self.aliases = aliases if isinstance(aliases, ShLayeredDict) else ShLayeredDict(aliases)
+        self.environ = environ if isinstance(environ, ShLayeredDict) else ShLayeredDict(environ)
         self.enclosed_cwd = enclosed_cwd
 
         self.sys_stdin__ = self.sys_stdin = sys_stdin or sys.stdin
         self.sys_stdout__ = self.sys_stdout = sys_stdout or sys.stdout
         self.sys_stderr__ = self.sys_stderr = sys_stderr or sys.stderr
+        # The path list is shared between states and never changed in place
         self.sys_path = sys_path or sys.path[:]
+        self.sys_argv = sys_argv or []
+        # os.environ and sys.path of the python script the worker is running
+        self.script_environ = None
+        self.script_sys_path = None
 
         self.enclosing_environ = {}
 
@@ -73,10 +194,10 @@ class ShState(object):
         This is used to carry child shell state to its parent shell
         :param ShState state: Other state
         """
-        self.aliases = dict(state.aliases)
+        self.aliases = state.aliases.copy()
         self.enclosed_cwd = os.getcwd()
-        self.environ = dict(state.environ)
-        self.sys_path = state.sys_path[:]
+        self.environ = state.environ.copy()
+        self.sys_path = state.sys_path
 
     @staticmethod
     def new_from_parent(state):
@@ -86,15 +207,16 @@ class ShState(object):
         :param state:
         :return:
         """
-        environ = dict(state.environ)
+        environ = state.environ.copy()
         environ.update(state.enclosing_environ)
-        return ShState(aliases=dict(state.aliases),
+        return ShState(aliases=state.aliases.copy(),
                        environ=environ,
                        enclosed_cwd=os.getcwd(),
                        sys_stdin=state.sys_stdin__,
                        sys_stdout=state.sys_stdout__,
                        sys_stderr=state.sys_stderr__,
-                       sys_path=state.sys_path[:])
+                       sys_path=state.sys_path,
+                       sys_argv=state.sys_argv[:])
 
 
 class ShWorkerRegistry(object):
@@ -133,10 +255,13 @@ class ShWorkerRegistry(object):
 
     def add_worker(self, worker):
         worker.job_id = self._get_job_id()
-        self.registry[worker.job_id] = worker
+        # Workers can be added and removed from multiple threads at the same time
+        with self._lock:
+            self.registry[worker.job_id] = worker
 
     def remove_worker(self, worker):
-        self.registry.pop(worker.job_id)
+        with self._lock:
+            self.registry.pop(worker.job_id)
 
     def get_worker(self, job_id):
         return self.registry.get(job_id, None)
@@ -158,8 +283,10 @@ class ShWorkerRegistry(object):
         # The worker removes itself from the registry when killed.
 
 
-class ShBaseThread(threading.Thread):
-    """ The basic Thread class provides life cycle management.
+class ShBaseThread(object):
+    """ A worker, i.e. a job that runs a command with its own state. It has the
+    life cycle management and the interface of a thread, but it is run by a
+    long-lived thread of a ShWorkerPool instead of a thread of its own.
     """
 
     CREATED = 1
@@ -167,11 +294,7 @@ class ShBaseThread(threading.Thread):
     STOPPED = 3
 
     def __init__(self, registry, parent, command, target=None):
-        super(ShBaseThread, self).__init__(group=None,
-                                           target=target,
-                                           name='_shthread',
-                                           args=(),
-                                           kwargs=None)
+        self.target = target
 
         # Registry management
         self.registry = weakref.proxy(registry)
@@ -180,7 +303,7 @@ class ShBaseThread(threading.Thread):
 
         # The command that the thread runs
         if command.__class__.__name__ == 'ShIO':
-            self.command = ''.join(command._buffer)[::-1].strip()
+            self.command = command.buffered().strip()
         else:
             self.command = command
 
@@ -194,6 +317,75 @@ class ShBaseThread(threading.Thread):
 
         self.killed = False
         self.child_thread = None
+        # The IO object the thread is blocked reading from, if any. It is woken
+        # up when the thread is killed.
+        self.blocked_on = None
+
+        # Ident of the pool thread that runs the worker
+        self.ident = None
+        self._status = self.CREATED
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+        # Kill must not reach the pool thread once the worker has stopped, as the
+        # pool thread goes on running other workers
+        self._kill_lock = threading.Lock()
+
+    def run(self):
+        """
+        The work of the worker, run by a pool thread. Same as Thread.run.
+        """
+        if self.target is not None:
+            self.target()
+
+    def bootstrap(self):
+        """
+        Run the worker in the current thread, which is a pool thread. Nothing
+        raised by the worker gets out, including a kill that arrives after the
+        worker's own handling of it. A kill raises at most once, so it is
+        enough to handle it once here. The pool thread wakes up the joiners
+        afterwards.
+        """
+        with self._kill_lock:
+            self.ident = threading.currentThread().ident
+            self._status = self.STARTED
+        _WORKER_LOCAL.worker = self
+        _WORKER_LOCAL.state = self.state
+        self._started.set()
+        try:
+            try:
+                self.run()
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except:
+                sys.stderr.write('Exception in job {}:\n{}\n'.format(self.job_id, traceback.format_exc()))
+            self._stop()
+        except KeyboardInterrupt:
+            self._stop()
+
+    def _stop(self):
+        with self._kill_lock:
+            self._status = self.STOPPED
+            self._revert_kill()
+        _WORKER_LOCAL.worker = None
+        _WORKER_LOCAL.state = None
+
+    def _revert_kill(self):
+        """
+        Undo the effects of a kill on the pool thread that have not shown yet.
+        Called with the kill lock acquired when the worker stops.
+        """
+        pass
+
+    def join(self, timeout=None):
+        """
+        Wait till the worker stops. Same as Thread.join.
+        """
+        self._stopped.wait(timeout)
+
+    def isAlive(self):
+        return self._status == self.STARTED
+
+    is_alive = isAlive
 
     def __repr__(self):
         command_str = str(self.command)
@@ -206,12 +398,7 @@ class ShBaseThread(threading.Thread):
         """
         Status of the thread. Created, Started or Stopped.
         """
-        if self.isAlive():
-            return self.STARTED
-        elif self._Thread__stopped:
-            return self.STOPPED
-        else:
-            return self.CREATED
+        return self._status
 
     def set_background(self, is_background=True):
         self.is_background = is_background
@@ -229,6 +416,14 @@ class ShBaseThread(threading.Thread):
         """
         return not isinstance(self.parent, ShBaseThread) and not self.is_background
 
+    def wake_up(self):
+        """
+        Wake up the thread if it is blocked reading input so it can respond to kill.
+        """
+        blocked_on = self.blocked_on
+        if blocked_on is not None:
+            blocked_on.wake_up()
+
     def cleanup(self):
         """
         End of life cycle management by remove itself from registry and unlink
@@ -242,26 +437,32 @@ class ShBaseThread(threading.Thread):
 
 # noinspection PyAttributeOutsideInit
 class ShTracedThread(ShBaseThread):
-    """ Killable thread implementation with trace """
+    """ Killable thread implementation with trace. Frames are traced line by line
+    only after the thread is killed, the frames that are running by then have the
+    trace injected.
+
+    The trace of a frame is only run in a thread that has a trace function, which
+    only the thread itself can install. Hence globaltrace is installed on the pool
+    thread for the whole run of the worker and every python function call pays a
+    call to it, also when the worker is never killed. This makes scripts that call many small
+    functions several times slower than with ShCtypesThread, see bench_threads.py.
+    """
 
     def __init__(self, registry, parent, command, target=None):
         super(ShTracedThread, self).__init__(
             registry, parent, command, target=target)
 
-    def start(self):
-        """Start the thread."""
-        self.__run_backup = self.run
-        self.run = self.__run  # Force the Thread to install our trace.
-        threading.Thread.start(self)
-
-    def __run(self):
-        """Hacked run function, which installs the trace."""
+    def run(self):
+        """Run with the trace installed."""
         sys.settrace(self.globaltrace)
-        self.__run_backup()
-        self.run = self.__run_backup
+        try:
+            super(ShTracedThread, self).run()
+        finally:
+            sys.settrace(None)
 
     def globaltrace(self, frame, why, arg):
-        return self.localtrace if why == 'call' else None
+        # Called for every new frame, which is traced line by line only after kill
+        return self.localtrace if self.killed else None
 
     def localtrace(self, frame, why, arg):
         if self.killed:
@@ -271,8 +472,35 @@ class ShTracedThread(ShBaseThread):
                 raise KeyboardInterrupt()
         return self.localtrace
 
+    def _inject_trace(self):
+        """
+        Trace the frames the thread is running, from the innermost one up to the
+        run method, so that the next executed line raises. Must be called with
+        the kill lock acquired while the thread is alive.
+        """
+        frames = []
+        frame = sys._current_frames().get(self.ident)
+        while frame is not None:
+            frames.append(frame)
+            if frame.f_code is _TRACED_RUN_CODE:
+                for frame in frames:
+                    frame.f_trace = self.localtrace
+                break
+            frame = frame.f_back
+
+    def _revert_kill(self):
+        # The pool thread runs other workers next, which must not be traced
+        sys.settrace(None)
+
     def kill(self):
-        self.killed = True
+        with self._kill_lock:
+            self.killed = True
+            if self.isAlive():
+                self._inject_trace()
+        self.wake_up()
+
+
+_TRACED_RUN_CODE = ShTracedThread.run.im_func.func_code
 
 
 class ShCtypesThread(ShBaseThread):
@@ -304,8 +532,114 @@ class ShCtypesThread(ShBaseThread):
             self.killed = True
             if self.child_thread:
                 self.child_thread.kill()
-            try:
-                res = self._async_raise()
-            except (ValueError, SystemError):
-                self.killed = False
+            with self._kill_lock:
+                if not self.isAlive():
+                    return
+                try:
+                    self._async_raise()
+                except (ValueError, SystemError):
+                    self.killed = False
+                else:
+                    self.wake_up()
+
+    def _revert_kill(self):
+        # The exception raised by kill may not have been delivered yet
+        if self.killed:
+            tid = self.ident
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(tid) if M_64 else tid, 0)
+
+
+class ShWorkerPool(object):
+    """
+    Long-lived threads that run the workers, so that a command does not need a
+    thread of its own. A pool thread runs one worker at a time and waits in the
+    pool in between. A new pool thread is added when none is idle, since workers
+    wait for their children, and idle threads beyond the size of the pool end.
 
+    :param int size: Maximum number of idle threads kept in the pool
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self.n_threads = 0  # number of live pool threads
+
+    def __del__(self):
+        self.shutdown()
+
+    def start(self, worker):
+        """
+        Start the worker on a pool thread. Same as Thread.start, it returns once
+        the worker has started.
+
+        :param ShBaseThread worker: The worker to start
+        """
+        with self._lock:
+            pool_thread = self._idle.pop() if self._idle else None
+            if pool_thread is None:
+                self.n_threads += 1
+        if pool_thread is None:
+            pool_thread = ShPoolThread(self)
+            pool_thread.start()
+        pool_thread.submit(worker)
+        worker._started.wait()
+
+    def _put_back(self, pool_thread):
+        """
+        :return: False if the pool is full and the thread should end
+        :rtype: bool
+        """
+        with self._lock:
+            if len(self._idle) >= self.size:
+                self.n_threads -= 1
+                return False
+            self._idle.append(pool_thread)
+            return True
+
+    def shutdown(self):
+        """
+        End all idle threads.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self.n_threads -= len(idle)
+        for pool_thread in idle:
+            pool_thread.submit(None)
+
+
+class ShPoolThread(threading.Thread):
+    """ A long-lived thread of a ShWorkerPool
+    """
+
+    def __init__(self, pool):
+        super(ShPoolThread, self).__init__(name='_shpool')
+        self.daemon = True
+        self.pool = weakref.ref(pool)
+        self._worker = None
+        self._ready = threading.Event()
+
+    def submit(self, worker):
+        """
+        Run the worker next, or end the thread if the worker is None.
+        """
+        self._worker = worker
+        self._ready.set()
+
+    def run(self):
+        while True:
+            self._ready.wait()
+            self._ready.clear()
+            worker, self._worker = self._worker, None
+            if worker is None:
+                return
+            worker.bootstrap()
+            pool = self.pool()
+            put_back = pool is not None and pool._put_back(self)
+            del pool
+            # Joiners are woken up once the thread is back in the pool, so that
+            # the command they run next reuses it
+            worker._stopped.set()
+            del worker
+            if not put_back:
+                return
@@ -0,0 +1,122 @@
+# coding=utf-8
+"""
+Benchmarks of the I/O paths. They are not run with the tests, run them with
+
+    python run_tests.py -p "bench_*.py"
+"""
+import sys
+import time
+import unittest
+from StringIO import StringIO
+
+import stash
+from system.shscreens import DEFAULT_CHAR, ns
+from system.shthreads import ShState, _WORKER_LOCAL
+
+
+def report(name, nbytes, seconds):
+    sys.__stdout__.write('\n%s: %.2f MB in %.3fs, %.2f MB/s\n' % (
+        name, nbytes / 1e6, seconds, nbytes / 1e6 / seconds))
+
+
+class IOBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        self.stash = stash.StaSh()
+        self.stash('clear')
+
+    def tearDown(self):
+        del self.stash
+
+    def test_write_plain_text(self):
+        """
+        Plain output goes through the stream to the screen
+        """
+        line = 'The quick brown fox jumps over the lazy dog 0123456789\n'
+        s = line * (4 * 1024 * 1024 / len(line))
+        t0 = time.time()
+        self.stash.io.write(s)
+        report('ShIO.write plain text', len(s), time.time() - t0)
+        assert self.stash.main_screen.text.endswith(line * 10)
+
+        # The same text fed char by char through the state machine
+        s = s[:len(s) / 16]
+        stream = self.stash.stream
+        t0 = time.time()
+        with self.stash.main_screen.acquire_lock():
+            for c in s.decode('utf-8'):
+                stream.consume(c)
+        report('ShStream.consume char by char', len(s), time.time() - t0)
+
+    def test_write_styled_text(self):
+        """
+        Output with escape sequences between short runs of plain text
+        """
+        line = self.stash.text_color('error:', 'red', always=True) + ' something went wrong\n'
+        s = line * (1024 * 1024 / len(line))
+        t0 = time.time()
+        self.stash.io.write(s)
+        report('ShIO.write styled text', len(s), time.time() - t0)
+        assert self.stash.main_screen.text.endswith('error: something went wrong\n')
+
+    def test_build_attributed_string(self):
+        """
+        Attributed strings of a long colored listing, built as the renderer does
+        on the device
+        """
+        stash = self.stash
+        lines = []
+        for i in range(5000):
+            lines.append('%s  1 user  staff  %5d Oct 17 05:19 %s\n' % (
+                stash.text_color('drwxr-xr-x', 'blue', always=True) if i % 3 else '-rw-r--r--',
+                i,
+                stash.text_bold(stash.text_color('file_%d.py' % i, 'green', always=True), always=True)))
+        s = ''.join(lines)
+        screen = stash.main_screen
+        screen.nlines_max = 5000
+        stash.io.write(s)
+        renderer = stash.renderer
+        with screen.acquire_lock():
+            screen.intact_right_bound = 0
+            chars = screen.renderable_chars
+            runs = screen.renderable_runs
+
+        n = 20
+        t0 = time.time()
+        for _ in range(n):
+            renderer._build_attributed_string(chars, runs)
+        report('Attributed string, cached attributes', len(chars) * n, time.time() - t0)
+
+        # Build the attributes for every run
+        default_attributes = renderer._get_attributes(DEFAULT_CHAR)
+        renderer._get_attributes = lambda style: (
+            default_attributes if renderer._same_style(style, DEFAULT_CHAR)
+            else ns(renderer._build_attributes(style)))
+        t0 = time.time()
+        for _ in range(n):
+            renderer._build_attributed_string(chars, runs)
+        report('Attributed string, attributes built per run', len(chars) * n, time.time() - t0)
+
+    def test_print_through_stdout_wrapper(self):
+        """
+        Print from a worker through the sys.stdout wrapper compared to printing
+        to the worker's stdout directly
+        """
+        line = 'The quick brown fox jumps over the lazy dog'
+        n = 200000
+        outs = StringIO()
+        _WORKER_LOCAL.state = ShState(sys_stdout=outs)  # pretend to be a worker
+        try:
+            t0 = time.time()
+            for _ in xrange(n):
+                print line
+            report('print through sys.stdout wrapper', len(line) * n, time.time() - t0)
+        finally:
+            del _WORKER_LOCAL.state
+        assert outs.getvalue() == (line + '\n') * n
+
+        outs = StringIO()
+        t0 = time.time()
+        for _ in xrange(n):
+            print >>outs, line
+        report('print to the stream directly', len(line) * n, time.time() - t0)
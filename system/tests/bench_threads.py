@@ -0,0 +1,97 @@
+# coding=utf-8
+"""
+Benchmarks of the worker threads. They are not run with the tests, run them with
+
+    python run_tests.py -p "bench_*.py"
+"""
+import sys
+import time
+import multiprocessing
+import unittest
+from StringIO import StringIO
+
+import stash
+from system.shprocesses import ShProcessPool
+from system.shthreads import ShBaseThread, ShCtypesThread, ShTracedThread, ShState
+
+
+class ThreadsBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        self.stash = stash.StaSh()
+        self.stash('cd $STASH_ROOT')
+        self.stash('BIN_PATH=$STASH_ROOT/system/tests/data:$BIN_PATH', persistent=True)
+
+    def tearDown(self):
+        del self.stash
+
+    def test_script_throughput(self):
+        """
+        A CPU bound script run by workers with and without kill support
+        """
+        results = {}
+        for name, thread_type in (('no kill', ShBaseThread),
+                                  ('ctypes', ShCtypesThread),
+                                  ('traced', ShTracedThread)):
+            self.stash.runtime.ShThread = thread_type
+            outs = StringIO()
+            t0 = time.time()
+            self.stash('bench_threads_1.py 30', final_outs=outs)
+            results[name] = time.time() - t0
+            assert outs.getvalue() == '832040 8999994\n', outs.getvalue()
+        sys.__stdout__.write('\n')
+        for name in ('no kill', 'ctypes', 'traced'):
+            sys.__stdout__.write('%s: %.3fs, %.2fx\n' % (name, results[name], results[name] / results['no kill']))
+
+    def test_parallel_jobs(self):
+        """
+        CPU bound background jobs run by threads and by processes. Processes only
+        run in parallel if the machine has more than one core.
+        """
+        runtime = self.stash.runtime
+        runtime.process_pool = ShProcessPool(4)
+        results = {}
+        try:
+            for name, process_commands in (('threads', set()), ('processes', set(['bench_threads_1']))):
+                runtime.process_commands = process_commands
+                outs = [StringIO() for _ in range(4)]
+                t0 = time.time()
+                for o in outs:
+                    self.stash('bench_threads_1.py 25 &', final_outs=o)
+                while runtime.worker_registry:
+                    time.sleep(0.01)
+                results[name] = time.time() - t0
+                # Concurrent scripts share the soft space of print, so spaces may move
+                assert all(o.getvalue().replace(' ', '') == '750257499997\n' for o in outs), \
+                    [o.getvalue() for o in outs]
+        finally:
+            runtime.process_pool.shutdown()
+        sys.__stdout__.write('\n4 jobs on %d cores, threads: %.3fs, processes: %.3fs, %.2fx\n' % (
+            multiprocessing.cpu_count(), results['threads'], results['processes'],
+            results['threads'] / results['processes']))
+
+    def test_nested_scripts(self):
+        """
+        Scripts nested 10 levels deep with a large environ
+        """
+        self.stash.runtime.state.environ.update(('BENCH_%d' % i, 'x' * 20) for i in range(1000))
+        n = 20
+        t0 = time.time()
+        for _ in range(n):
+            self.stash('bench_threads_2.py 10')
+        seconds = (time.time() - t0) / n
+        sys.__stdout__.write('\n10 nested scripts: %.2fms, environ of the deepest %.1fKB\n' % (
+            seconds * 1e3, self.stash.bench_environ_bytes / 1e3))
+
+        # The states alone, created from parents and carried back
+        n = 1000
+        t0 = time.time()
+        for _ in range(n):
+            states = [self.stash.runtime.state]
+            for _ in range(10):
+                states.append(ShState.new_from_parent(states[-1]))
+            for state in reversed(states[1:]):
+                state.return_value = 0
+                states.pop()
+                states[-1].copy(state)
+        sys.__stdout__.write('10 nested states: %.1fus\n' % ((time.time() - t0) / n * 1e6))
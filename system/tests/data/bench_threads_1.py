@@ -0,0 +1,15 @@
+import sys
+
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+
+def count(n):
+    total = 0
+    for i in xrange(n):
+        total += i % 7
+    return total
+
+n = int(sys.argv[1])
+print fib(n), count(n * 100000)
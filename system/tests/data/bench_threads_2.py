@@ -0,0 +1,25 @@
+import sys
+
+
+def environ_bytes():
+    """
+    Memory taken by the environ of this worker and all its ancestors, counting
+    storage shared between them once
+    """
+    seen = set()
+    total = 0
+    worker, _ = _stash.runtime.get_current_worker_and_state()
+    while hasattr(worker, 'job_id'):  # up to the runtime
+        environ = worker.state.environ
+        for storage in getattr(environ, '_layers', [environ]):
+            if id(storage) not in seen:
+                seen.add(id(storage))
+                total += sys.getsizeof(storage)
+        worker = worker.parent
+    return total
+
+depth = int(sys.argv[1])
+if depth > 0:
+    _stash('bench_threads_2.py %d' % (depth - 1))
+else:
+    _stash.bench_environ_bytes = environ_bytes()
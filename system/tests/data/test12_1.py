@@ -0,0 +1,5 @@
+import itertools
+
+# Endless output only stops when the next command in the pipe closes its input
+for i in itertools.count():
+    print i
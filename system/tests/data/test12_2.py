@@ -0,0 +1,4 @@
+import sys
+
+for _ in range(3):
+    sys.stdout.write(sys.stdin.readline())
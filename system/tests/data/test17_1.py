@@ -0,0 +1,7 @@
+import sys
+from StringIO import StringIO
+
+print 'stdout', isinstance(sys.stdout, StringIO)
+print 'stderr', isinstance(sys.stderr, StringIO)
+print >>sys.stderr, 'to stderr'
+sys.stdout.write('%s\n' % sys.argv[1:])
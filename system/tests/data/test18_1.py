@@ -0,0 +1,5 @@
+import sys
+
+for i in range(int(sys.argv[1])):
+    print i
+print >>sys.stderr, 'done'
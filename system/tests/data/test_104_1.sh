@@ -0,0 +1,6 @@
+# Every value depends on the positional parameter of this script
+A=$1 B="$1-$1" C=\x41$1 D=${1}x E='$1' F=~/$1
+A=$1 B="$1-$1" C=\x41$1 D=${1}x E='$1' F=~/$1
+A=$1 B="$1-$1" C=\x41$1 D=${1}x E='$1' F=~/$1
+A=$1 B="$1-$1" C=\x41$1 D=${1}x E='$1' F=~/$1
+A=$1 B="$1-$1" C=\x41$1 D=${1}x E='$1' F=~/$1
@@ -0,0 +1,5 @@
+# coding=utf-8
+import sys
+
+line = sys.stdin.readline()
+print 'got {}'.format(line.strip())
@@ -0,0 +1,2 @@
+worker, _ = _stash.runtime.get_current_worker_and_state()
+print worker.job_id, worker.isAlive(), worker.__class__.__name__
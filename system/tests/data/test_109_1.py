@@ -0,0 +1,10 @@
+import os
+import sys
+import time
+
+name, path = sys.argv[1:]
+os.environ['MINE'] = name
+sys.path.insert(0, path)
+time.sleep(0.5)
+mod = __import__('test_109_%s' % name)
+print name, os.environ['MINE'], sys.path[0] == path, mod.value
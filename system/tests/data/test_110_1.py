@@ -0,0 +1,8 @@
+import os
+import sys
+
+print os.getpid() != int(os.environ['PARENT_PID']), hasattr(os, 'test_110_ran'), sys.argv[1:], os.environ['A'], os.path.basename(os.getcwd())
+os.test_110_ran = True
+print sys.stdin.readline().strip()
+print >>sys.stderr, 'to stderr'
+sys.exit(3)
@@ -0,0 +1,10 @@
+import os
+import sys
+import copy
+
+sys.path.append(sys.argv[1])
+import test_114_pkg.sub
+environ = copy.copy(os.environ)
+environ['MINE'] = 'copy'
+os.environ.data['MINE'] = 'data'
+print test_114_pkg.sub.value, isinstance(os.environ, dict), os.environ['MINE'], environ['MINE']
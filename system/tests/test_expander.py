@@ -3,6 +3,7 @@ import os
 import unittest
 
 import stash
+from system.shcommon import ShBadSubstitution
 
 class ExpanderTests(unittest.TestCase):
 
@@ -23,6 +24,17 @@ class ExpanderTests(unittest.TestCase):
         pipe_sequence = self._get_pipe_sequence(r'ls $SELFUPDATE_BRANCH')
         assert pipe_sequence.lst[0].args[0] == 'master'
 
+    def test_envars_substitution(self):
+        expandvars = self.stash.runtime.expander.expandvars
+        environ = {'A': '42', 'B': 'x', '1': 'one', '?': 0}
+        assert expandvars('$A$B', environ) == '42x'
+        assert expandvars('${A}_$B-$C', environ) == '42_x-'
+        assert expandvars('$A_B', environ) == ''
+        assert expandvars('$1$?', environ) == 'one0'
+        assert expandvars('$ $- a$', environ) == '$ $- a$'
+        for s in ('${}', '${A', '${A-B}'):
+            self.assertRaises(ShBadSubstitution, expandvars, s, environ)
+
     def test_tilda(self):
         pipe_sequence = self._get_pipe_sequence(r'ls ~/')
         assert pipe_sequence.lst[0].args[0] == os.path.expanduser('~/')
@@ -43,6 +55,25 @@ class ExpanderTests(unittest.TestCase):
         pipe_sequence = self._get_pipe_sequence(r'ls stash*')
         assert 'getstash.py' not in pipe_sequence.lst[0].args
 
+    def test_wildcards_listdir_cached(self):
+        listdir = os.listdir
+        dirnames = []
+
+        def counting_listdir(dirname):
+            dirnames.append(dirname)
+            return listdir(dirname)
+
+        os.listdir = counting_listdir
+        try:
+            pipe_sequence = self._get_pipe_sequence(r'ls *.md CHANGES.?d plain \*.md')
+        finally:
+            os.listdir = listdir
+        args = pipe_sequence.lst[0].args
+        assert 'README.md' in args
+        assert args.count('CHANGES.md') == 2
+        assert args[-2:] == ['plain', '*.md']
+        assert len(dirnames) == 1
+
     def test_escapes(self):
         pipe_sequence = self._get_pipe_sequence(r'ls \n')
         assert pipe_sequence.lst[0].args[0] == '\n'
@@ -0,0 +1,156 @@
+# coding=utf-8
+import threading
+import unittest
+
+import pyparsing as pp
+
+import stash
+from system.shparsers import ShParser
+
+class ParserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stash = stash.StaSh()
+        self.parser = self.stash.runtime.parser
+        self.parser.clear_cache()
+
+    def tearDown(self):
+        del self.stash
+
+    def test_cache_hit(self):
+        line = r'ls -1 "$HOME" | grep x > out.txt'
+        tokens1, parsed1 = self.parser.parse(line)
+        tokens2, parsed2 = self.parser.parse(line)
+        assert self.parser.cache_misses == 1
+        assert self.parser.cache_hits == 1
+        assert [repr(t) for t in tokens1] == [repr(t) for t in tokens2]
+        assert parsed1 is parsed2
+
+    def test_cache_fresh_tokens(self):
+        line = r'A=42 echo $A'
+        tokens1, _ = self.parser.parse(line)
+        tokens1[0].parts.tok = 'modified'
+        tokens1[1].tok = 'modified'
+        tokens1[1].parts[0].tok = 'modified'
+        tokens2, _ = self.parser.parse(line)
+        assert tokens2[0].parts.tok == '42'
+        assert tokens2[1].tok == 'echo'
+        assert tokens2[1].parts[0].tok == 'echo'
+
+    def test_cache_bounded(self):
+        self.parser.cache_size = 2
+        for line in ('echo 1', 'echo 2', 'echo 3'):
+            self.parser.parse(line)
+        assert len(self.parser._cache) == 2
+        self.parser.parse('echo 1')  # evicted, so parsed again
+        assert self.parser.cache_misses == 4
+        assert self.parser.cache_hits == 0
+
+    def test_history_subs_does_not_corrupt_cache(self):
+        self.stash.runtime.history = ['echo hello']
+        expanded = self.stash.runtime.expander.expand('!!')
+        newline, _ = expanded.next()
+        assert newline == 'echo hello'
+        tokens, _ = self.parser.parse('!!')
+        assert tokens[0].tok == '!!'
+
+    def test_grammar_shared(self):
+        parser = ShParser()
+        assert parser.parser is self.parser.parser
+        assert parser.parser_within_dq is self.parser.parser_within_dq
+
+    def test_concurrent_parse(self):
+        parser = ShParser(cache_size=0)
+        errors = []
+
+        def fn(i):
+            line = 'A%d=%d echo "x %d" | grep y%d > f%d' % (i, i, i, i, i)
+            for _ in range(20):
+                tokens, parsed = parser.parse(line)
+                toks = [t.tok for t in tokens]
+                if toks != ['A%d=%d' % (i, i), 'echo', '"x %d"' % i, '|', 'grep', 'y%d' % i, '>', 'f%d' % i]:
+                    errors.append(toks)
+
+        threads = [threading.Thread(target=fn, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == [], errors
+
+
+# Lines from test_expander plus a few more covering the rest of the grammar
+_DIFFERENTIAL_CORPUS = [
+    r'ls $SELFUPDATE_BRANCH',
+    r'ls ~/',
+    r'ls *',
+    r'ls README.?d',
+    r'ls *stash*',
+    r'ls stash*',
+    r'ls \n',
+    r'ls \033[32m',
+    r'ls \x1b[32m',
+    r'ls "$SELFUPDATE_BRANCH"',
+    r'ls "~/"',
+    r'ls "*"',
+    r'ls "\033[32m"',
+    r"ls '$SELFUPDATE_BRANCH'",
+    r"ls '*'",
+    r"ls '\033[32m'",
+    r'ls >> somefile',
+    r'ls -1 > &3',
+    r'A=42 B="$A x" echo $A$B # comment',
+    r'\ls -1 | grep "a b"c | wc -l; echo `pwd` &',
+    r'A=1',
+    r'echo \0333 \07 \x1 a&3',
+]
+
+
+class ParserEngineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stash = stash.StaSh()
+        self.stash('cd $STASH_ROOT')
+        self.pyparsing_parser = ShParser(engine='pyparsing')
+        self.fast_parser = ShParser(engine='fast')
+
+    def tearDown(self):
+        del self.stash
+
+    @staticmethod
+    def _structure(parsed):
+        ret = []
+        for pipe_sequence in parsed:
+            if isinstance(pipe_sequence, basestring):  # punctuator
+                ret.append(pipe_sequence)
+                continue
+            for sc in pipe_sequence:
+                if isinstance(sc, basestring):  # pipe op
+                    ret.append(sc)
+                else:
+                    ret.append((list(sc.cmd_prefix), sc.cmd_word, list(sc.args), list(sc.io_redirect)))
+        return ret
+
+    def _expand(self, parser, line):
+        self.stash.runtime.parser = parser
+        expanded = self.stash.runtime.expander.expand(line)
+        expanded.next()
+        return [pipe_sequence.lst[0].__repr2__() for pipe_sequence in expanded]
+
+    def test_same_tokens(self):
+        for line in _DIFFERENTIAL_CORPUS:
+            tokens1, parsed1 = self.pyparsing_parser.parse(line)
+            tokens2, parsed2 = self.fast_parser.parse(line)
+            assert repr(tokens1) == repr(tokens2), line
+            assert self._structure(parsed1) == self._structure(parsed2), line
+
+    def test_same_expansion(self):
+        for line in _DIFFERENTIAL_CORPUS:
+            if '`' in line:  # command substitution needs a running shell
+                continue
+            assert self._expand(self.pyparsing_parser, line) == self._expand(self.fast_parser, line), line
+
+    def test_syntax_error(self):
+        for line in ('ls ; ; ls', 'ls >', '| ls', 'ls "abc'):
+            self.assertRaises(pp.ParseException, self.pyparsing_parser.parse, line)
+            self.assertRaises(pp.ParseException, self.fast_parser.parse, line)
@@ -1,8 +1,16 @@
 # coding=utf-8
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from StringIO import StringIO
 
 import stash
+from system.shcommon import ShFileNotFound
+from system.shio import ShBufferedOutput
+from system.shruntime import ShCodeCache
 
 class RuntimeTests(unittest.TestCase):
 
@@ -130,3 +138,177 @@ A is{0}
 [stash]$ """
         self.do_test('test11.sh', cmp_str, ensure_undefined=('A',))
 
+    def test_12(self):
+        cmp_str = r"""[stash]$ 0
+1
+2
+[stash]$ """
+        self.do_test('test12_1.py | test12_2.py', cmp_str)
+
+    def test_13(self):
+        """
+        command hash is used and invalidated by directory mtime and BIN_PATH changes
+        """
+        rt = self.stash.runtime
+        rt.reset_command_hash()
+        rt.find_script_file('test12_2')
+
+        listdir = os.listdir
+        dirnames = []
+
+        def counting_listdir(dirname):
+            dirnames.append(dirname)
+            return listdir(dirname)
+
+        os.listdir = counting_listdir
+        try:
+            for _ in range(5):
+                rt.find_script_file('test12_2')
+        finally:
+            os.listdir = listdir
+        assert dirnames == []
+        assert rt.command_hash['test12_2'][1] == 6
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.stash('BIN_PATH=%s:$BIN_PATH' % tmpdir)
+            self.assertRaises(ShFileNotFound, rt.find_script_file, 'test13_new')
+            assert rt.command_hash == {}
+            with open(os.path.join(tmpdir, 'test13_new.py'), 'w'):
+                pass
+            os.utime(tmpdir, (0, 0))  # make sure the mtime changes
+            assert rt.find_script_file('test13_new') == os.path.join(tmpdir, 'test13_new.py')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_14(self):
+        stash_root = self.stash.runtime.state.environ_get('STASH_ROOT')
+        cmp_str = r"""[stash]$ hits	command
+   2	{0}/bin/hash.py
+   1	{0}/bin/wc.py
+[stash]$ """.format(stash_root)
+        self.do_test('hash -r; hash wc; hash', cmp_str)
+
+    def test_15(self):
+        """
+        compiled code of scripts is cached in memory and on disk
+        """
+        code_cache = self.stash.runtime.code_cache
+        code_cache.clear()
+        for _ in range(3):
+            self.stash('echo hello', final_outs=StringIO())
+        assert code_cache.misses == 1
+        assert code_cache.hits == 2
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            script_file = os.path.join(tmpdir, 'script.py')
+            with open(script_file, 'w') as outs:
+                outs.write('x = 1\n')
+            code_cache = ShCodeCache(cache_dir=os.path.join(tmpdir, 'cache'))
+            code = code_cache.get_code(script_file)
+            assert code_cache.get_code(script_file) is code
+
+            code_cache = ShCodeCache(cache_dir=os.path.join(tmpdir, 'cache'))
+            code_cache.get_code(script_file)
+            assert code_cache.disk_hits == 1
+
+            with open(script_file, 'w') as outs:
+                outs.write('x = 42\n')
+            os.utime(script_file, (0, 0))  # make sure the mtime changes
+            ns = {}
+            exec code_cache.get_code(script_file) in ns
+            assert ns['x'] == 42
+            assert code_cache.disk_hits == 1 and code_cache.misses == 2
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_16(self):
+        """
+        Input is read across the pushed chunks
+        """
+        io = self.stash.io
+        io.push('echo a\nec')
+        io.push('ho b\necho')
+        assert list(io.readline_no_block()) == ['echo a\n', 'echo b\n']
+        assert io.buffered() == 'echo'
+        io.push(' c\nabc')
+        assert io.readline() == 'echo c\n'
+        assert io.read(2) == 'ab'
+        io.push('def\nghi\n\0')
+        assert io.read(3) == 'cde'
+        assert io.readlines() == 'f\nghi\n'
+        io.push('xyz\0')
+        assert io.read() == 'xyz'
+        assert io.buffered() == ''
+
+    def test_17(self):
+        """
+        The stdio of a worker go to its own streams
+        """
+        outs = StringIO()
+        self.stash('test17_1.py a b', final_outs=outs)
+        assert outs.getvalue() == "stdout True\nstderr False\n['a', 'b']\n"
+        assert self.stash.main_screen.text.endswith('to stderr\n[stash]$ ')
+
+    def test_18(self):
+        """
+        Output of scripts to the screen is written in batches
+        """
+        self.stash.runtime.output_buffer_mode = 'throughput'
+        feeds = []
+        feed = self.stash.stream.feed
+        self.stash.stream.feed = lambda chars, *args, **kwargs: (feeds.append(chars), feed(chars, *args, **kwargs))
+        try:
+            self.stash('test18_1.py 100000')
+        finally:
+            del self.stash.stream.feed
+        assert self.stash.main_screen.text.endswith('99998\n99999\ndone\n[stash]$ ')
+        # Feeds are chunked by size only, instead of one per print
+        assert len(feeds) < 2 * sum(len(chars) for chars in feeds) / self.stash.io.chunk_size
+
+        # A partial line is held back no longer than the time budget
+        self.stash('clear')
+        output_buffer = ShBufferedOutput(self.stash.io, lines_max=10, time_max=0.05)
+        output_buffer.write('abc')
+        assert not self.stash.main_screen.text.endswith('abc')
+        time.sleep(0.5)
+        assert self.stash.main_screen.text.endswith('abc')
+
+        # Timed flushes are done by one long-lived thread, not by a thread per batch
+        n_threads = threading.active_count()
+        for _ in range(20):
+            output_buffer.write('x')
+            output_buffer.close()
+        assert threading.active_count() == n_threads
+        output_buffer.write('def')
+        time.sleep(0.5)
+        assert self.stash.main_screen.text.endswith('abc' + 'x' * 20 + 'def')
+
+    def test_19(self):
+        """
+        sys.argv still dispatches to each script after the python command or a
+        script has changed it
+        """
+        outs = StringIO()
+        self.stash('python -c "import sys; sys.argv += [\'c\']; print sys.argv" a b', final_outs=outs)
+        self.stash('python -c "import sys; sys.argv = [\'x\']"', final_outs=outs)
+        self.stash('test17_1.py d e', final_outs=outs)
+        assert outs.getvalue().splitlines() == [
+            "['python.py', 'a', 'b', 'c']",
+            'stdout True',
+            'stderr False',
+            "['d', 'e']",
+        ], outs.getvalue()
+
+    def test_20(self):
+        """
+        The return value of a pipe sequence is that of its first failing command,
+        and the commands after it still run
+        """
+        outs = StringIO()
+        self.stash('python -c "import sys; sys.exit(3)" | echo after; echo $?', final_outs=outs)
+        self.stash('echo a | python -c "import sys; sys.exit(4)" | cat; echo $?', final_outs=outs)
+        self.stash('echo a | cat; echo $?', final_outs=outs)
+        self.stash('python -c "import sys; sys.exit(5)"; no_such_command | cat; echo $?', final_outs=outs)
+        assert outs.getvalue() == 'after\n3\n4\na\n0\n5\n', repr(outs.getvalue())
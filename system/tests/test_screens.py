@@ -0,0 +1,169 @@
+# coding=utf-8
+import time
+import unittest
+from collections import deque
+
+import stash
+
+
+class ScreensTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stash = stash.StaSh()
+        self.screen = self.stash.main_screen
+        with self.screen.acquire_lock():
+            self.screen.reset()
+
+    def tearDown(self):
+        del self.stash
+
+    def get_runs(self):
+        """
+        Text pieces and their foreground colors of the whole screen
+        """
+        self.screen.intact_right_bound = 0
+        text = self.screen.renderable_chars
+        return [(text[start:start + length], style.fg)
+                for start, length, style in self.screen.renderable_runs]
+
+    def test_styled_runs(self):
+        self.stash.io.write('plain ' + self.stash.text_color('red', 'red', always=True) + ' more\n')
+        assert self.screen.text == 'plain red more\n'
+        assert self.get_runs() == [('plain ', 'default'), ('red', 'red'), (' more\n', 'default')]
+
+        # Only one entry in the style table for the same style
+        n_styles = len(self.screen._styles)
+        self.stash.io.write(self.stash.text_color('again', 'red', always=True))
+        assert len(self.screen._styles) == n_styles
+        assert self.get_runs()[-1] == ('again', 'red')
+
+    def test_replace_in_range(self):
+        self.stash.io.write('ab' + self.stash.text_color('cdef', 'red', always=True) + 'gh')
+        with self.screen.acquire_lock():
+            self.screen.replace_in_range((3, 5), 'XYZ')
+        assert self.screen.text == 'abcXYZfgh'
+        assert self.get_runs() == [('ab', 'default'), ('c', 'red'), ('XYZ', 'default'),
+                                   ('f', 'red'), ('gh', 'default')]
+        assert self.screen.cursor_x == 6
+
+        with self.screen.acquire_lock():
+            self.screen.replace_in_range((2, 7), '')
+        assert self.screen.text == 'abgh'
+        assert self.get_runs() == [('abgh', 'default')]
+
+    def test_nlines_max(self):
+        nlines_max = self.screen.nlines_max
+        self.stash.io.write(''.join(self.stash.text_color('%d\n' % i, 'red' if i % 2 else 'blue', always=True)
+                                    for i in range(nlines_max + 10)))
+        assert self.screen.nlines == nlines_max
+        assert self.screen.text.startswith('10\n11\n')
+        runs = self.get_runs()
+        assert runs[:2] == [('10\n', 'blue'), ('11\n', 'red')]
+        assert len(runs) == nlines_max
+        assert [line for _, line in self.screen.scrollback] == ['%d\n' % i for i in range(10)]
+        assert self.screen.scrollback[-1][0] + len('9\n') == self.screen._offset
+
+    def test_scrollback_max(self):
+        self.screen.scrollback = deque(maxlen=50000)
+        line = 'The quick brown fox jumps over the lazy dog\n'
+        t0 = time.time()
+        self.stash.io.write(line * 40000)
+        assert time.time() - t0 < 2, 'drawing slows down with a long scrollback'
+        assert self.screen.nlines == self.screen.nlines_max
+        assert len(self.screen.scrollback) == 40000 - self.screen.nlines_max
+        # Drawing with a full scrollback is as fast
+        t0 = time.time()
+        self.stash.io.write(line * 20000)
+        assert time.time() - t0 < 1, 'drawing slows down with a full scrollback'
+        assert len(self.screen.scrollback) == 50000
+        assert self.screen.scrollback_text == line * 50000
+
+    def test_x_modifiable(self):
+        def check():
+            text = self.screen.text
+            idx = text.rfind('\n', self.screen.x_drawend)
+            assert self.screen.x_modifiable == (idx + 1 if idx != -1 else self.screen.x_drawend)
+
+        self.stash.io.write('line 1\nline 2\nprompt$ ')
+        check()
+        with self.screen.acquire_lock():
+            self.screen.replace_in_range(None, 'echo a')
+            check()
+            self.screen.replace_in_range((7, 8), 'LINE\n2\nline ')  # before the last LF
+            check()
+            self.screen.replace_in_range(None, '\n')
+            check()
+            self.screen.replace_in_range((3, len(self.screen.text)), 'x')  # all LFs removed
+            check()
+            self.screen._pop_chars(2)
+            check()
+        self.stash.io.write(''.join('%d\n' % i for i in range(self.screen.nlines_max + 10)) + 'abc')
+        check()
+
+    def test_replace_lines(self):
+        def check():
+            lines = list(self.screen._lines)
+            assert self.screen.nlines == self.screen.text.count('\n'), lines
+            assert all(line.count('\n') == 1 and line.endswith('\n') for line in lines[:-1]), lines
+            assert '\n' not in lines[-1], lines
+
+        self.stash.io.write('line 1\nline 2\n$ ')
+        with self.screen.acquire_lock():
+            # Enter a command on the input line, as the mini buffer does
+            self.screen.replace_in_range(None, 'echo a\n')
+            check()
+            self.screen.replace_in_range((2, 6), 'A\nB\n')  # spans the first LF
+            check()
+            self.screen.replace_in_range((9, 9), '')  # start of a middle line
+            check()
+            self.screen.replace_in_range((9, 10), 'x')  # a middle line without adding a LF
+            check()
+            self.screen.replace_in_range((0, 0), '\n\n')
+            check()
+            assert self.screen.text == '\n\nliA\nB\n\nlixe 2\n$ echo a\n'
+        self.stash.io.write('more\n')
+        check()
+
+    def test_edit_input_line(self):
+        self.stash.io.write(''.join('%d\n' % i for i in range(self.screen.nlines_max)) + '$ ')
+        with self.screen.acquire_lock():
+            self.screen.clean()
+            self.screen.replace_in_range(None, 'echo world')
+            assert self.screen.intact_right_bound == self.screen.x_modifiable
+            self.screen.clean()
+            # Insert in the middle of the input line
+            self.screen.replace_in_range((5, 5), 'hello ', relative_to_x_modifiable=True)
+            assert self.screen.modifiable_chars == 'echo hello world'
+            assert self.screen.cursor_x == self.screen.x_modifiable + 11
+            assert self.screen.intact_right_bound == self.screen.x_modifiable + 5
+            # Delete a word
+            self.screen.replace_in_range((5, 11), '', relative_to_x_modifiable=True)
+            assert self.screen.modifiable_chars == 'echo world'
+            assert self.screen.text.endswith('\n$ echo world')
+            assert self.screen.nlines == self.screen.nlines_max
+        runs = self.get_runs()
+        assert len(runs) == 1 and runs[0][0].endswith('$ echo world')
+
+    def test_render_scheduler(self):
+        renderer = self.stash.renderer
+        time.sleep(0.2)  # let any pending frame finish
+        frames_rendered = renderer.frames_rendered
+        frames_coalesced = renderer.frames_coalesced
+
+        # The first frame after idle is rendered right away
+        renderer.render()
+        time.sleep(0.05)
+        assert renderer.frames_rendered == frames_rendered + 1
+
+        # A flood of render requests is coalesced into a few frames
+        t0 = time.time()
+        while time.time() - t0 < 0.5:
+            renderer.render()
+            time.sleep(0.001)
+        time.sleep(0.2)
+        n_frames = renderer.frames_rendered - frames_rendered - 1
+        # The frame rate drops to the minimum under the flood
+        assert 0 < n_frames <= 0.5 / renderer.RENDER_INTERVAL + 3, n_frames
+        assert renderer.frames_coalesced > frames_coalesced
+        assert renderer.render_interval == renderer.RENDER_INTERVAL
+        assert renderer.render_thread.isAlive()
@@ -1,10 +1,18 @@
 # coding=utf-8
 import os
+import sys
 import time
+import shutil
+import tempfile
+import threading
 import unittest
 from StringIO import StringIO
 
 import stash
+from system.shcommon import _OS_ENVIRON, _SYS_PATH
+from system.shparsers import ShPipeSequence
+from system.shprocesses import ShProcessPool
+from system.shthreads import ShTracedThread, ShLayeredDict
 
 class ThreadsTests(unittest.TestCase):
 
@@ -23,7 +31,20 @@ class ThreadsTests(unittest.TestCase):
         """
         background thread clears properly
         """
+        # The job may print before the prompt of the line that started it, as in
+        # any shell. It is held back till the line has finished so the output is
+        # always the same.
+        line_done = threading.Event()
+
+        class HeldThread(self.stash.runtime.ShThread):
+            def run(self):
+                if self.is_background:
+                    line_done.wait()
+                super(HeldThread, self).run()
+
+        self.stash.runtime.ShThread = HeldThread
         self.stash('test_101_1.py &')
+        line_done.set()
         time.sleep(4)
         cmp_str = r"""[stash]$ [stash]$ sleeping ... 0
 sleeping ... 1
@@ -67,5 +88,290 @@ test_102_1.py
 """
         assert outs1.getvalue() == cmp_str2, 'output not identical'
 
+    def test_104(self):
+        """
+        Hundreds of parallel workers parse and expand their own lines without interfering
+        """
+        n_workers = 200
+        records = []
+        expand = self.stash.runtime.expander.expand
+
+        def recording_expand(line):
+            for ret in expand(line):
+                if isinstance(ret, ShPipeSequence) and ret.lst[0].assignments:
+                    records.append(dict((a.identifier, a.value) for a in ret.lst[0].assignments))
+                yield ret
+
+        self.stash.runtime.expander.expand = recording_expand
+        saved_os_environ = os.environ
+        # Switch threads more often to make any interference show up
+        saved_check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(10)
+        try:
+            # All jobs are started from a single line so they run at the same time
+            self.stash(' '.join('test_104_1.sh %d &' % i for i in range(n_workers)))
+            for _ in range(600):
+                if len(self.stash.runtime.worker_registry) == 0:
+                    break
+                time.sleep(0.1)
+        finally:
+            sys.setcheckinterval(saved_check_interval)
+            self.stash.runtime.expander.expand = expand
+
+        assert os.environ is saved_os_environ, 'global environ is modified'
+        home = self.stash.runtime.state.environ_get('HOME')
+        assert len(records) == 5 * n_workers, 'expected %d expansions, got %d' % (5 * n_workers, len(records))
+        for r in records:
+            a = r['A']
+            assert r['B'] == a + '-' + a, r
+            assert r['C'] == 'A' + a, r
+            assert r['D'] == a + 'x', r
+            assert r['E'] == '$1', r
+            assert r['F'] == home + '/' + a, r
+        assert sorted(int(r['A']) for r in records) == sorted(range(n_workers) * 5), 'expansions are mixed up'
+
+    def test_105(self):
+        """
+        A worker blocked reading input wakes up as soon as input is pushed and can be killed
+        """
+        outs = StringIO()
+        worker = self.stash.runtime.run('test_105_1.py', final_outs=outs)
+        time.sleep(0.5)
+        assert worker.isAlive(), 'worker should be waiting for input'
+        t0 = time.time()
+        self.stash.io.push('hello\n')
+        worker.join(2)
+        assert not worker.isAlive(), 'worker did not wake up'
+        assert time.time() - t0 < 0.1, 'worker woke up too late'
+        assert outs.getvalue() == 'got hello\n', 'output not identical'
+
+        # The traced thread is used because it can be killed on any platform
+        self.stash.runtime.ShThread = ShTracedThread
+        worker = self.stash.runtime.run('test_105_1.py', final_outs=outs)
+        time.sleep(0.5)
+        t0 = time.time()
+        worker.kill()
+        worker.join(2)
+        assert not worker.isAlive(), 'worker blocked on input cannot be killed'
+        assert time.time() - t0 < 0.5, 'worker took too long to be killed'
+
+    def test_106(self):
+        """
+        Workers run on reused pool threads and each is the current worker while it
+        runs, also after a worker is killed
+        """
+        worker_pool = self.stash.runtime.worker_pool
+        outs = StringIO()
+        for _ in range(10):
+            self.stash('test_106_1.py', final_outs=outs)
+        n_threads = worker_pool.n_threads
+        assert n_threads <= 3, 'pool threads are not reused'
+        self.stash.runtime.ShThread = ShTracedThread
+        worker = self.stash.runtime.run('test_105_1.py', final_outs=outs)
+        time.sleep(0.3)
+        worker.kill()
+        worker.join(2)
+        assert not worker.isAlive(), 'worker cannot be killed'
+        for _ in range(10):
+            self.stash('test_106_1.py', final_outs=outs)
+        assert worker_pool.n_threads == n_threads, 'the pool thread of the killed worker is lost'
+
+        lines = outs.getvalue().splitlines()
+        assert len(lines) == 20
+        assert len(set(line.split()[0] for line in lines)) == 20, 'job ids are reused'
+        assert all(line.endswith(' True ShCtypesThread') for line in lines[:10]), lines
+        assert all(line.endswith(' True ShTracedThread') for line in lines[10:]), lines
+
+    def test_107(self):
+        """
+        A traced worker busy in a loop without function calls can be killed
+        """
+        self.stash.runtime.ShThread = ShTracedThread
+        worker = self.stash.runtime.run('test_107_1.py')
+        time.sleep(0.3)
+        assert worker.isAlive(), 'worker should be looping'
+        t0 = time.time()
+        worker.kill()
+        worker.join(2)
+        assert not worker.isAlive(), 'busy worker cannot be killed'
+        assert time.time() - t0 < 0.5, 'worker took too long to be killed'
+
+    def test_108(self):
+        """
+        Copies of a layered dict share their items but not their changes
+        """
+        d = ShLayeredDict({'A': 1, 'B': 2})
+        c = d.copy()
+        c['A'] = 10
+        del c['B']
+        c['C'] = 3
+        d['D'] = 4
+        assert d.to_dict() == {'A': 1, 'B': 2, 'D': 4}
+        assert c.to_dict() == {'A': 10, 'C': 3}
+        assert 'B' not in c and c.get('B') is None and len(c) == 2
+        self.assertRaises(KeyError, c.__getitem__, 'B')
+        self.assertRaises(KeyError, c.__delitem__, 'B')
+        assert sorted(c.keys()) == ['A', 'C']
+
+        # Carried back to the parent as in persistent commands
+        d = c.copy()
+        c['A'] = 100
+        assert d['A'] == 10 and c['A'] == 100
+
+        # Repeated copies do not stack up layers without limit
+        for i in range(100):
+            d = d.copy()
+            d[i] = i
+        assert len(d._layers) <= ShLayeredDict.max_depth
+        assert all(d[i] == i for i in range(100)) and len(d) == 102
+
+    def test_109(self):
+        """
+        Scripts running at the same time have their own os.environ and sys.path
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            outs = {}
+            for name in ('a', 'b'):
+                os.mkdir(os.path.join(tmpdir, name))
+                with open(os.path.join(tmpdir, name, 'test_109_%s.py' % name), 'w') as f:
+                    f.write('value = %r\n' % name)
+                outs[name] = StringIO()
+                self.stash('test_109_1.py %s %s &' % (name, os.path.join(tmpdir, name)), final_outs=outs[name])
+            for _ in range(50):
+                if len(self.stash.runtime.worker_registry) == 0:
+                    break
+                time.sleep(0.1)
+            assert outs['a'].getvalue() == 'a a True a\n', outs['a'].getvalue()
+            assert outs['b'].getvalue() == 'b b True b\n', outs['b'].getvalue()
+            assert 'MINE' not in os.environ
+            assert not [p for p in sys.path if p.startswith(tmpdir)]
+        finally:
+            shutil.rmtree(tmpdir)
+            for name in ('a', 'b'):
+                sys.modules.pop('test_109_%s' % name, None)
+
+    def test_110(self):
+        """
+        Python commands configured to run in processes get their own interpreter
+        and stream their stdio through the worker
+        """
+        runtime = self.stash.runtime
+        runtime.process_pool = ShProcessPool(1)
+        runtime.process_commands = set(['test_110_1', 'test_107_1'])
+        try:
+            # Each script runs in a new process, also when the pool process is reused
+            for _ in range(2):
+                outs = StringIO()
+                self.stash('cd system/tests/data; echo hello | A=42 PARENT_PID=%d test_110_1.py x y' % os.getpid(),
+                           final_outs=outs)
+                assert outs.getvalue() == "True False ['x', 'y'] 42 data\nhello\n", outs.getvalue()
+                assert self.stash.main_screen.text.endswith('to stderr\n[data]$ ')
+                assert runtime.state.return_value == 3
+                assert 'A' not in os.environ
+                self.stash('cd $STASH_ROOT')
+
+            # The script of a killed worker is ended and its pool process is reused
+            self.stash.runtime.ShThread = ShTracedThread
+            worker = runtime.run('test_107_1.py')
+            time.sleep(0.3)
+            worker.kill()
+            worker.join(2)
+            assert not worker.isAlive(), 'worker waiting on a process cannot be killed'
+            outs = StringIO()
+            self.stash('cd system/tests/data; echo again | A=1 PARENT_PID=0 test_110_1.py', final_outs=outs)
+            assert outs.getvalue() == "True False [] 1 data\nagain\n", outs.getvalue()
+            assert runtime.process_pool.n_processes == 1
+            assert len(runtime.process_pool._idle) == 1
 
+            # A script that ends its process has the exit code as return value
+            runtime.process_commands.add('python')
+            self.stash('python -c "import os; os._exit(5)"')
+            assert runtime.state.return_value == 5
+        finally:
+            runtime.process_pool.shutdown()
+
+    def test_111(self):
+        """
+        A worker blocked reading a pipe can be killed, together with its pipe sequence
+        """
+        self.stash.runtime.ShThread = ShTracedThread
+        worker = self.stash.runtime.run('test_105_1.py | test12_2.py')
+        time.sleep(0.5)
+        assert len(self.stash.runtime.worker_registry) == 2, 'both commands should be waiting'
+        t0 = time.time()
+        worker.kill()
+        worker.join(2)
+        assert not worker.isAlive(), 'worker blocked on a pipe cannot be killed'
+        assert time.time() - t0 < 0.5, 'worker took too long to be killed'
 
+    def test_112(self):
+        """
+        A copy of a layered dict does not see writes that the original gets while
+        it is being copied
+        """
+        d = ShLayeredDict({'A': 0})
+        done = []
+
+        def write():
+            i = 0
+            while not done:
+                i += 1
+                d['A'] = i
+
+        saved_check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            copies = []
+            for _ in range(20000):
+                c = d.copy()
+                copies.append((c, c['A']))
+        finally:
+            done.append(True)
+            writer.join()
+            sys.setcheckinterval(saved_check_interval)
+        changed = [(value, c['A']) for c, value in copies if c['A'] != value]
+        assert not changed, 'copies see writes made after them: %s' % changed[:5]
+
+    def test_113(self):
+        """
+        A command of a pipe sequence still reading from the terminal is killed when
+        the pipe sequence is killed after its last command has finished
+        """
+        self.stash.runtime.ShThread = ShTracedThread
+        outs = StringIO()
+        worker = self.stash.runtime.run('test_105_1.py | echo done', final_outs=outs)
+        time.sleep(0.5)
+        assert outs.getvalue() == 'done\n', 'last command should have finished'
+        assert len(self.stash.runtime.worker_registry) == 2, 'first command should be waiting'
+        t0 = time.time()
+        worker.kill()
+        worker.join(2)
+        assert not worker.isAlive(), 'pipe sequence cannot be killed'
+        assert time.time() - t0 < 0.5, 'pipe sequence took too long to be killed'
+        assert len(self.stash.runtime.worker_registry) == 0, 'first command is left running'
+
+    def test_114(self):
+        """
+        The os.environ and sys.path of a script work as regular ones, and are the
+        regular ones again after the script has ended
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmpdir, 'test_114_pkg'))
+            with open(os.path.join(tmpdir, 'test_114_pkg', '__init__.py'), 'w') as f:
+                f.write('')
+            with open(os.path.join(tmpdir, 'test_114_pkg', 'sub.py'), 'w') as f:
+                f.write("value = 'sub'\n")
+            outs = StringIO()
+            self.stash('test_114_1.py %s' % tmpdir, final_outs=outs)
+            assert outs.getvalue() == 'sub True data copy\n', outs.getvalue()
+            assert os.environ is _OS_ENVIRON and sys.path is _SYS_PATH, 'wrappers are left installed'
+            assert 'MINE' not in os.environ
+            assert tmpdir not in sys.path
+        finally:
+            shutil.rmtree(tmpdir)
+            sys.modules.pop('test_114_pkg', None)
+            sys.modules.pop('test_114_pkg.sub', None)